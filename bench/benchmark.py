@@ -0,0 +1,307 @@
+"""Benchmark e prove di carico di Dove si Va su un evento sintetico.
+
+Genera squadre, partecipanti (con coordinate), giochi e punteggi su un database
+locale (SQLite temporaneo, oppure quello indicato con --db) usando il geocoder
+finto, poi misura latenza, throughput e numero di query SQL per ogni scenario.
+
+    python bench/benchmark.py                          # evento medio, stampa i risultati
+    python bench/benchmark.py --salva bench/baseline.json
+    python bench/benchmark.py --confronta bench/baseline.json
+
+Il database viene svuotato e riempito da capo: con --db su un database che contiene già
+dati serve anche --distruggi-dati.
+
+Con --confronta esce con codice 1 se uno scenario sequenziale esegue più query o se uno
+scenario peggiora oltre --tolleranza (e --soglia-ms). Il numero di query arriva dall'header
+Server-Timing: per le risposte in streaming conta solo le query eseguite prima dell'invio.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+CARTELLA_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROVINCE = ["BO", "MO", "RE", "PR", "PC", "FE", "RA", "FC", "RN", "MI", "VR", "PD", "FI", "AN", "RM"]
+MANEGGI = [f"Maneggio {nome}" for nome in ("Stella", "Quercia", "Sole", "Collina", "Fiume", "Prato", "Bosco")]
+PREFISSO_CONCORRENTI = "concorrente: "
+
+
+def prepara_ambiente(args):
+    """Configura l'app prima di importarla: main.py legge l'ambiente all'import."""
+    if args.db:
+        os.environ["DATABASE_URL"] = args.db
+    else:
+        cartella = tempfile.mkdtemp(prefix="dovesiva-bench-")
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(cartella, 'bench.db')}"
+    os.environ["GEOCODER_BACKEND"] = "finto"
+    os.environ["GEOCODE_ASYNC"] = "0"
+    os.environ["RICHIESTA_LENTA_MS"] = "1e9"
+    os.environ.pop("PROFILING", None)
+    sys.path.insert(0, CARTELLA_REPO)
+    import main
+    return main
+
+
+def genera_evento(main, squadre, partecipanti, giochi, seed, distruggi_dati=False):
+    """Riempie il database con un evento sintetico, usando inserimenti in blocco."""
+    casuale = random.Random(seed)
+    db = main.db
+    with main.app.app_context():
+        modelli = (main.Squadra, main.Gioco, main.Partecipante, main.Punteggio)
+        if not distruggi_dati and any(db.session.query(m.id).first() for m in modelli):
+            url = db.engine.url.render_as_string(hide_password=True)
+            sys.exit(f"Il database {url} contiene già dati e verrebbe svuotato: usa --distruggi-dati per procedere.")
+        db.drop_all()
+        db.create_all()
+        main._inizializza_contatori()
+
+        db.session.execute(db.insert(main.Squadra), [{"nome": f"Squadra {i:03d}"} for i in range(1, squadre + 1)])
+        nomi_giochi = ["Quiz"] + [f"Gioco {i:02d}" for i in range(1, giochi)]
+        db.session.execute(db.insert(main.Gioco), [{"nome": nome} for nome in nomi_giochi])
+        squadra_ids = [id for id, in db.session.query(main.Squadra.id)]
+        gioco_ids = [id for id, in db.session.query(main.Gioco.id)]
+
+        geocoder = main.GeocoderFinto()
+        righe = []
+        for i in range(partecipanti):
+            luogo = f"Comune {casuale.randrange(partecipanti // 4 + 1)}"
+            provincia = casuale.choice(PROVINCE)
+            lat, lng = geocoder.geocode(f"{luogo}, {provincia}, Italia")
+            righe.append({
+                "nome": f"Cavaliere {i:05d}",
+                "nascita": date(1950, 1, 1) + timedelta(days=casuale.randrange(365 * 70)),
+                "sesso": casuale.choice("FM"),
+                "luogo": luogo,
+                "provincia": provincia,
+                "maneggio": casuale.choice(MANEGGI),
+                "squadra_id": casuale.choice(squadra_ids),
+                "geo_chiave": main.chiave_geocodifica(luogo, provincia),
+                "lat": lat,
+                "lng": lng,
+            })
+        for riga, distanza in zip(righe, main.distanze_da_base([(r["lat"], r["lng"]) for r in righe])):
+            riga["distanza_km"] = distanza
+        for inizio in range(0, len(righe), main.BLOCCO_IMPORT):
+            db.session.execute(db.insert(main.Partecipante), righe[inizio:inizio + main.BLOCCO_IMPORT])
+
+        db.session.execute(db.insert(main.Punteggio), [
+            {"squadra_id": s, "gioco_id": g, "punti": round(casuale.uniform(0, 20), 1)}
+            for s in squadra_ids for g in gioco_ids
+        ])
+        db.session.commit()
+        main.ricostruisci_classifica()
+        main.incrementa_versione("partecipanti")
+        db.session.commit()
+        return squadra_ids, gioco_ids
+
+
+def svuota_cache(main):
+    """Svuota le cache in-process (pagine, statistiche, tabellone) per misurare il caso a freddo."""
+    main._cache.clear()
+
+
+def query_da_risposta(risposta):
+    """Numero di query SQL riportato dall'header Server-Timing dell'app."""
+    trovato = re.search(r'desc="(\d+) query"', risposta.headers.get("Server-Timing", ""))
+    return int(trovato.group(1)) if trovato else None
+
+
+def misura(client, richiesta, ripetizioni):
+    """Esegue `richiesta(client)` più volte; restituisce durate (s) e query per chiamata."""
+    durate, query, errori = [], [], 0
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        risposta = richiesta(client)
+        risposta.get_data()  # consuma anche le risposte in streaming
+        durate.append(time.perf_counter() - inizio)
+        if risposta.status_code >= 400:
+            errori += 1
+        numero = query_da_risposta(risposta)
+        if numero is not None:
+            query.append(numero)
+    return durate, query, errori
+
+
+def misura_concorrente(main, richiesta, thread, ripetizioni):
+    """Come misura(), ma con `thread` client in parallelo; aggiunge il throughput."""
+    risultati = []
+
+    def lavora(indice):
+        risultati.append(misura(main.app.test_client(), lambda c: richiesta(c, indice), ripetizioni))
+
+    inizio = time.perf_counter()
+    lavoratori = [threading.Thread(target=lavora, args=(i,)) for i in range(thread)]
+    for t in lavoratori:
+        t.start()
+    for t in lavoratori:
+        t.join()
+    totale = time.perf_counter() - inizio
+    durate = [d for r in risultati for d in r[0]]
+    query = [q for r in risultati for q in r[1]]
+    errori = sum(r[2] for r in risultati)
+    return durate, query, errori, len(durate) / totale
+
+
+def riassumi(durate, query, errori, throughput=None):
+    ordinate = sorted(durate)
+    risultato = {
+        "richieste": len(durate),
+        "media_ms": round(statistics.mean(durate) * 1000, 2),
+        "p50_ms": round(ordinate[len(ordinate) // 2] * 1000, 2),
+        "p95_ms": round(ordinate[min(len(ordinate) - 1, int(len(ordinate) * 0.95))] * 1000, 2),
+        "query_per_richiesta": round(statistics.mean(query), 1) if query else None,
+        "errori": errori,
+    }
+    risultato["richieste_al_s"] = round(throughput if throughput else len(durate) / sum(durate), 1)
+    return risultato
+
+
+def scenari(main, squadra_ids, gioco_ids, args):
+    casuale = random.Random(args.seed)
+    quiz_id = gioco_ids[0]
+    altri_giochi = gioco_ids[1:] or gioco_ids
+
+    def salva_punteggio(client, _indice=0):
+        squadra, gioco = casuale.choice(squadra_ids), casuale.choice(altri_giochi)
+        return client.post(f"/squadre/{squadra}/punteggio/{gioco}", data={"punti": str(casuale.randint(0, 20))})
+
+    with main.app.test_client() as client:
+        etag = client.get("/").headers["ETag"]
+    griglia = {"punteggi": [
+        {"squadra_id": s, "gioco_id": g, "quiz": [1, 2, 3, 4, 5]} if g == quiz_id
+        else {"squadra_id": s, "gioco_id": g, "punti": 7.5}
+        for s in squadra_ids for g in gioco_ids
+    ]}
+    csv_import = ("nome,nascita,sesso,luogo,provincia,maneggio,squadra\n" + "".join(
+        f"Nuovo {i},2010-01-01,F,Comune {i % 40},BO,Maneggio Stella,Squadra 001\n" for i in range(500)
+    )).encode()
+
+    sequenziali = {
+        "home (cache fredda)": lambda c: (svuota_cache(main), c.get("/"))[1],
+        "home (cache calda)": lambda c: c.get("/"),
+        "home (304)": lambda c: c.get("/", headers={"If-None-Match": etag}),
+        "statistiche": lambda c: c.get("/statistiche"),
+        "api statistiche": lambda c: c.get("/api/statistiche"),
+        "partecipanti (pagina)": lambda c: c.get("/partecipanti"),
+        "partecipanti (filtro)": lambda c: c.get("/partecipanti?provincia=bo&q=1"),
+        "api partecipanti (tutti)": lambda c: c.get("/api/partecipanti"),
+        "squadre": lambda c: c.get("/squadre"),
+        "dettaglio squadra": lambda c: c.get(f"/squadre/{squadra_ids[0]}"),
+        "tabellone": lambda c: c.get("/tabellone"),
+        "tabellone csv": lambda c: c.get("/tabellone.csv"),
+        "dettaglio gioco": lambda c: c.get(f"/giochi/{altri_giochi[0]}"),
+        "salva punteggio": salva_punteggio,
+        "griglia punteggi (json)": lambda c: c.post("/punteggi", json=griglia),
+        "import 500 righe (verifica)": lambda c: c.post(
+            "/partecipanti/importa",
+            data={"file": (io.BytesIO(csv_import), "bench.csv"), "dry_run": "1"},
+            content_type="multipart/form-data",
+        ),
+    }
+    risultati = {}
+    with main.app.test_client() as client:
+        for nome, richiesta in sequenziali.items():
+            misura(client, richiesta, 2)  # riscaldamento
+            risultati[nome] = riassumi(*misura(client, richiesta, args.ripetizioni))
+            print(f"  {nome:<32} {risultati[nome]['p50_ms']:>9.2f} ms p50", file=sys.stderr)
+
+    concorrenti = {
+        PREFISSO_CONCORRENTI + "inserimento punteggi": lambda c, i: salva_punteggio(c),
+        PREFISSO_CONCORRENTI + "refresh home": lambda c, i: c.get("/"),
+        # metà dei client scrive, metà ricarica: la cache della home viene invalidata di continuo
+        PREFISSO_CONCORRENTI + "refresh durante inserimenti": lambda c, i: salva_punteggio(c) if i % 2 else c.get("/"),
+    }
+    for nome, richiesta in concorrenti.items():
+        risultati[nome] = riassumi(*misura_concorrente(main, richiesta, args.thread, args.ripetizioni))
+        print(f"  {nome:<32} {risultati[nome]['richieste_al_s']:>9.1f} req/s", file=sys.stderr)
+    return risultati
+
+
+def confronta(attuali, baseline, tolleranza, soglia_ms):
+    """Stampa le differenze di p50 e query rispetto alla baseline; True se c'è una regressione.
+
+    Un p50 più lento conta solo se supera sia la tolleranza relativa sia `soglia_ms`: sotto il
+    millisecondo il rumore della macchina domina. Un aumento delle query conta solo negli scenari
+    sequenziali: in quelli concorrenti la media dipende da come si intrecciano i thread (quante
+    richieste trovano la cache appena invalidata).
+    """
+    regressione = False
+    print(f"{'scenario':<42} {'p50 base':>10} {'p50 ora':>10} {'diff':>8} {'query':>11}")
+    for nome, attuale in attuali.items():
+        base = baseline.get(nome)
+        if base is None:
+            print(f"{nome:<42} {'—':>10} {attuale['p50_ms']:>10.2f} {'nuovo':>8}")
+            continue
+        diff = (attuale["p50_ms"] - base["p50_ms"]) / base["p50_ms"] if base["p50_ms"] else 0.0
+        query = f"{base['query_per_richiesta']}→{attuale['query_per_richiesta']}"
+        peggiorato = (diff > tolleranza and attuale["p50_ms"] - base["p50_ms"] > soglia_ms) or (
+            not nome.startswith(PREFISSO_CONCORRENTI)
+            and base["query_per_richiesta"] is not None
+            and attuale["query_per_richiesta"] is not None
+            and attuale["query_per_richiesta"] > base["query_per_richiesta"]
+        )
+        regressione = regressione or peggiorato
+        segno = " ⚠" if peggiorato else ""
+        print(f"{nome:<42} {base['p50_ms']:>10.2f} {attuale['p50_ms']:>10.2f} {diff:>+8.0%} {query:>11}{segno}")
+    return regressione
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="DATABASE_URL da usare (default: SQLite temporaneo)")
+    parser.add_argument("--squadre", type=int, default=30)
+    parser.add_argument("--partecipanti", type=int, default=500)
+    parser.add_argument("--giochi", type=int, default=10)
+    parser.add_argument("--ripetizioni", type=int, default=50, help="richieste per scenario (e per thread)")
+    parser.add_argument("--thread", type=int, default=8, help="client paralleli negli scenari concorrenti")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--distruggi-dati", action="store_true", help="consente di svuotare un --db che contiene dati")
+    parser.add_argument("--salva", metavar="FILE", help="salva i risultati come nuova baseline")
+    parser.add_argument("--confronta", metavar="FILE", help="confronta con una baseline salvata")
+    parser.add_argument("--tolleranza", type=float, default=0.25, help="peggioramento p50 accettato (0.25 = 25%%)")
+    parser.add_argument("--soglia-ms", type=float, default=2.0, help="peggioramento p50 minimo, in ms, da segnalare")
+    args = parser.parse_args()
+
+    main = prepara_ambiente(args)
+    print(
+        f"Evento sintetico: {args.squadre} squadre, {args.partecipanti} partecipanti, {args.giochi} giochi",
+        file=sys.stderr,
+    )
+    squadra_ids, gioco_ids = genera_evento(
+        main, args.squadre, args.partecipanti, args.giochi, args.seed, args.distruggi_dati
+    )
+    risultati = scenari(main, squadra_ids, gioco_ids, args)
+
+    with main.app.app_context():
+        dialetto = main.db.engine.dialect.name
+    documento = {
+        "parametri": {k: getattr(args, k) for k in ("squadre", "partecipanti", "giochi", "ripetizioni", "thread", "seed")},
+        "database": dialetto,
+        "scenari": risultati,
+    }
+    if args.salva:
+        with open(args.salva, "w") as f:
+            json.dump(documento, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+    if args.confronta:
+        with open(args.confronta) as f:
+            baseline = json.load(f)
+        if baseline.get("parametri") != documento["parametri"]:
+            print("Attenzione: parametri diversi dalla baseline, il confronto è indicativo.", file=sys.stderr)
+        if confronta(risultati, baseline["scenari"], args.tolleranza, args.soglia_ms):
+            sys.exit(1)
+    elif not args.salva:
+        print(json.dumps(documento, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main_cli()
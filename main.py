@@ -1,10 +1,45 @@
+import base64
+import csv
+import importlib
+import io
+import itertools
+import json
+import math
 import os
-from flask import Flask, render_template, request, redirect, url_for
+import random
+import re
+import select
+import threading
+import time
+import types
+import unicodedata
+import zlib
+import click
+import cProfile
+import pstats
+from flask import (
+    Flask, Response, g, has_request_context, jsonify, render_template, request, redirect,
+    stream_with_context, url_for,
+)
+from werkzeug.http import is_resource_modified
 from flask_sqlalchemy import SQLAlchemy
-from datetime import date
-from geopy.distance import geodesic
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload
+from datetime import date, datetime, timedelta, timezone
 from geopy.geocoders import Nominatim
 
+# con i worker gevent (Procfile) anche psycopg2 deve cedere il controllo durante le query
+try:
+    from gevent import monkey
+    from psycogreen.gevent import patch_psycopg
+except ImportError:  # niente gevent, o niente psycopg2 (SQLite in locale)
+    monkey = None
+if monkey is not None and monkey.is_module_patched("socket"):
+    patch_psycopg()
+
 # -------------------
 # CONFIG APP
 # -------------------
@@ -17,9 +52,203 @@ if not db_url:
 app.config["SQLALCHEMY_DATABASE_URI"] = db_url.replace("postgres://", "postgresql://", 1)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# geocodifica: "nominatim", "finto" (locale, per test) oppure "modulo:Classe"
+app.config["GEOCODER_BACKEND"] = os.environ.get("GEOCODER_BACKEND", "nominatim")
+app.config["GEOCODE_ASYNC"] = os.environ.get("GEOCODE_ASYNC", "1") != "0"
+app.config["GEOCODE_TIMEOUT"] = float(os.environ.get("GEOCODE_TIMEOUT", 5))
+app.config["GEOCODE_TENTATIVI"] = int(os.environ.get("GEOCODE_TENTATIVI", 5))
+app.config["GEOCODE_TTL_NEGATIVO_ORE"] = float(os.environ.get("GEOCODE_TTL_NEGATIVO_ORE", 24 * 7))
+app.config["GEOCODE_RISCANSIONE"] = float(os.environ.get("GEOCODE_RISCANSIONE", 60))
+
+# punto da cui si misura la distanza dei partecipanti (dopo un cambio: flask ricalcola-distanze)
+app.config["BASE_COORDS"] = (
+    float(os.environ.get("BASE_LAT", 44.4949)),
+    float(os.environ.get("BASE_LNG", 11.3426)),
+)
+app.config["BASE_NOME"] = os.environ.get("BASE_NOME", "Bologna")
+
+# classifica in diretta (SSE): ogni quanti secondi controllare la versione senza LISTEN/NOTIFY
+app.config["SSE_POLLING"] = float(os.environ.get("SSE_POLLING", 2))
+app.config["SSE_KEEPALIVE"] = float(os.environ.get("SSE_KEEPALIVE", 15))
+# stream aperti al massimo per worker; oltre, gli schermi leggono /api/classifica ogni CLASSIFICA_POLLING secondi
+app.config["SSE_MAX_CLIENT"] = int(os.environ.get("SSE_MAX_CLIENT", 500))
+app.config["CLASSIFICA_POLLING"] = float(os.environ.get("CLASSIFICA_POLLING", 15))
+
+# strumentazione: richieste lente nel log, profilazione con header X-Profile o PROFILING=tutte
+app.config["RICHIESTA_LENTA_MS"] = float(os.environ.get("RICHIESTA_LENTA_MS", 500))
+# una richiesta profilata per volta per processo; con i worker gevent il profilo include anche
+# le altre greenlet servite nel frattempo (stesso thread), quindi va letto con cautela
+app.config["PROFILING"] = os.environ.get("PROFILING", "")  # "", "header" oppure "tutte"
+
 db = SQLAlchemy(app)
 
-geolocator = Nominatim(user_agent="dovesiva")
+# -------------------
+# METRICHE
+# -------------------
+BUCKET_SECONDI = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKET_QUERY = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Metriche:
+    """Contatori e istogrammi in memoria, esportati in formato testo Prometheus.
+
+    I valori sono per processo: con più worker gunicorn ogni scrape legge il worker che risponde.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contatori = {}  # (nome, etichette) → valore
+        self._istogrammi = {}  # (nome, etichette) → [conteggi per bucket, somma, totale]
+        self._bucket = {}
+        self._aiuto = {}
+
+    def definisci(self, nome, aiuto, bucket=None):
+        self._aiuto[nome] = aiuto
+        if bucket:
+            self._bucket[nome] = bucket
+
+    def incrementa(self, nome, valore=1, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock:
+            self._contatori[chiave] = self._contatori.get(chiave, 0) + valore
+
+    def osserva(self, nome, valore, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        bucket = self._bucket[nome]
+        with self._lock:
+            dati = self._istogrammi.setdefault(chiave, [[0] * len(bucket), 0.0, 0])
+            for i, limite in enumerate(bucket):
+                if valore <= limite:
+                    dati[0][i] += 1
+            dati[1] += valore
+            dati[2] += 1
+
+    def esporta(self, indicatori=()):
+        """Testo per /metrics; `indicatori` sono gauge (nome, aiuto, valore) letti al momento."""
+
+        def etichette(coppie):
+            if not coppie:
+                return ""
+            valori = ",".join(
+                '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for k, v in coppie
+            )
+            return "{" + valori + "}"
+
+        righe = []
+        with self._lock:
+            contatori = sorted(self._contatori.items())
+            istogrammi = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._istogrammi.items())
+        visti = set()
+        for (nome, coppie), valore in contatori:
+            if nome not in visti:
+                visti.add(nome)
+                righe += [f"# HELP {nome} {self._aiuto.get(nome, nome)}", f"# TYPE {nome} counter"]
+            righe.append(f"{nome}{etichette(coppie)} {valore}")
+        for (nome, coppie), (conteggi, somma, totale) in istogrammi:
+            if nome not in visti:
+                visti.add(nome)
+                righe += [f"# HELP {nome} {self._aiuto.get(nome, nome)}", f"# TYPE {nome} histogram"]
+            for limite, conteggio in zip(self._bucket[nome], conteggi):
+                righe.append(f"{nome}_bucket{etichette(coppie + (('le', limite),))} {conteggio}")
+            righe.append(f"{nome}_bucket{etichette(coppie + (('le', '+Inf'),))} {totale}")
+            righe.append(f"{nome}_sum{etichette(coppie)} {somma}")
+            righe.append(f"{nome}_count{etichette(coppie)} {totale}")
+        for nome, aiuto, valore in indicatori:
+            righe += [f"# HELP {nome} {aiuto}", f"# TYPE {nome} gauge", f"{nome} {valore}"]
+        return "\n".join(righe) + "\n"
+
+
+metriche = Metriche()
+metriche.definisci("dovesiva_richieste_totale", "Richieste HTTP servite.")
+metriche.definisci("dovesiva_richiesta_secondi", "Durata delle richieste HTTP.", BUCKET_SECONDI)
+metriche.definisci("dovesiva_sql_query_per_richiesta", "Query SQL eseguite per richiesta.", BUCKET_QUERY)
+metriche.definisci("dovesiva_sql_query_totale", "Query SQL eseguite.")
+metriche.definisci("dovesiva_sql_secondi_totale", "Tempo speso nelle query SQL.")
+metriche.definisci("dovesiva_geocoder_secondi", "Durata delle chiamate al geocoder esterno.", BUCKET_SECONDI)
+metriche.definisci("dovesiva_geocoder_chiamate_totale", "Chiamate al geocoder esterno per esito.")
+metriche.definisci("dovesiva_geocode_cache_totale", "Ricerche nella cache di geocodifica (hit/miss).")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _inizio_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("inizio_query", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _fine_query(conn, cursor, statement, parameters, context, executemany):
+    durata = time.perf_counter() - conn.info["inizio_query"].pop()
+    endpoint = (request.endpoint or "sconosciuto") if has_request_context() else "background"
+    metriche.incrementa("dovesiva_sql_query_totale", endpoint=endpoint)
+    metriche.incrementa("dovesiva_sql_secondi_totale", durata, endpoint=endpoint)
+    if has_request_context() and "query" in g:
+        g.query.append((durata, statement))
+
+
+@event.listens_for(Engine, "handle_error")
+def _errore_query(contesto):
+    if contesto.connection is not None and contesto.connection.info.get("inizio_query"):
+        contesto.connection.info["inizio_query"].pop()
+
+
+# un solo cProfile attivo per thread: sotto gevent tutte le richieste condividono il thread
+# e un secondo enable() guasta il primo (fino alla 3.11) o solleva un errore (dalla 3.12)
+_profilazione = threading.Lock()
+
+
+@app.before_request
+def _inizio_richiesta():
+    g.inizio = time.perf_counter()
+    g.query = []
+    profiling = app.config["PROFILING"]
+    if profiling == "tutte" or (profiling == "header" and request.headers.get("X-Profile") == "1"):
+        # se un'altra richiesta è già in profilazione questa viene servita senza profilo
+        if _profilazione.acquire(blocking=False):
+            g.profilo = cProfile.Profile()
+            g.profilo.enable()
+
+
+@app.after_request
+def _fine_richiesta(risposta):
+    if "inizio" not in g:
+        return risposta
+    # per le risposte in streaming misura fino all'invio delle intestazioni
+    durata = time.perf_counter() - g.inizio
+    endpoint = request.endpoint or "sconosciuto"
+    metriche.incrementa(
+        "dovesiva_richieste_totale", endpoint=endpoint, metodo=request.method, stato=risposta.status_code
+    )
+    metriche.osserva("dovesiva_richiesta_secondi", durata, endpoint=endpoint)
+    metriche.osserva("dovesiva_sql_query_per_richiesta", len(g.query), endpoint=endpoint)
+    risposta.headers["Server-Timing"] = (
+        f"app;dur={durata * 1000:.1f}, sql;dur={sum(d for d, _ in g.query) * 1000:.1f};desc=\"{len(g.query)} query\""
+    )
+
+    if durata * 1000 >= app.config["RICHIESTA_LENTA_MS"]:
+        dettaglio = "\n".join(f"  {d * 1000:7.1f} ms  {sql}" for d, sql in g.query[:50])
+        app.logger.warning(
+            "Richiesta lenta: %s %s %.0f ms, %d query SQL (%.0f ms)\n%s",
+            request.method, request.full_path, durata * 1000, len(g.query),
+            sum(d for d, _ in g.query) * 1000, dettaglio,
+        )
+    profilo = g.pop("profilo", None)
+    if profilo is not None:
+        profilo.disable()
+        _profilazione.release()
+        testo = io.StringIO()
+        pstats.Stats(profilo, stream=testo).sort_stats("cumulative").print_stats(30)
+        app.logger.warning("Profilo di %s %s\n%s", request.method, request.full_path, testo.getvalue())
+    return risposta
+
+
+@app.teardown_request
+def _chiudi_profilo(errore):
+    # dopo un'eccezione after_request non viene chiamato: il profilo va comunque fermato
+    profilo = g.pop("profilo", None)
+    if profilo is not None:
+        profilo.disable()
+        _profilazione.release()
+
 
 # -------------------
 # MODELS
@@ -29,7 +258,8 @@ class Squadra(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False, unique=True)
     partecipanti = db.relationship("Partecipante", backref="squadra", lazy=True)
-    punteggi = db.relationship("Punteggio", backref="squadra", lazy=True)
+    punteggi = db.relationship("Punteggio", backref="squadra", lazy=True, cascade="all, delete-orphan")
+    totale = db.relationship("TotaleSquadra", uselist=False, lazy=True, cascade="all, delete-orphan")
 
 
 class Partecipante(db.Model):
@@ -43,14 +273,26 @@ class Partecipante(db.Model):
     maneggio = db.Column(db.String(100))
     lat = db.Column(db.Float)
     lng = db.Column(db.Float)
+    geo_chiave = db.Column(db.String(220), index=True)  # luogo|provincia normalizzati
+    distanza_km = db.Column(db.Float, index=True)  # dalla BASE_COORDS
     squadra_id = db.Column(db.Integer, db.ForeignKey("squadre.id"))
 
+    __table_args__ = (
+        db.Index("ix_partecipanti_sesso_nascita", "sesso", "nascita"),
+        db.Index("ix_partecipanti_nascita", "nascita"),
+        db.Index("ix_partecipanti_maneggio", "maneggio"),
+        # elenco paginato per (nome, id), anche filtrato per maneggio o provincia (senza maiuscole)
+        db.Index("ix_partecipanti_nome_id", "nome", "id"),
+        db.Index("ix_partecipanti_lower_maneggio_nome", db.func.lower(maneggio), "nome", "id"),
+        db.Index("ix_partecipanti_lower_provincia_nome", db.func.lower(provincia), "nome", "id"),
+    )
+
 
 class Gioco(db.Model):
     __tablename__ = "giochi"
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False, unique=True)
-    punteggi = db.relationship("Punteggio", backref="gioco", lazy=True)
+    punteggi = db.relationship("Punteggio", backref="gioco", lazy=True, cascade="all, delete-orphan")
 
 
 class Punteggio(db.Model):
@@ -60,59 +302,1095 @@ class Punteggio(db.Model):
     gioco_id = db.Column(db.Integer, db.ForeignKey("giochi.id"))
     squadra_id = db.Column(db.Integer, db.ForeignKey("squadre.id"))
 
+    __table_args__ = (
+        # copre anche le ricerche per sola squadra
+        db.Index("uq_punteggi_squadra_gioco", "squadra_id", "gioco_id", unique=True),
+    )
+
+
+class TotaleSquadra(db.Model):
+    """Classifica materializzata: somma dei punteggi per squadra."""
+    __tablename__ = "team_totals"
+    squadra_id = db.Column(db.Integer, db.ForeignKey("squadre.id"), primary_key=True)
+    totale = db.Column(db.Float, nullable=False, default=0, index=True)
+
+
+class Contatore(db.Model):
+    """Contatori di versione condivisi tra i worker gunicorn (invalidano le cache in-process).
+
+    Il contatore "geocoder" fa eccezione: la sua data è il turno dell'ultima chiamata al geocoder.
+    """
+    __tablename__ = "contatori"
+    nome = db.Column(db.String(50), primary_key=True)
+    valore = db.Column(db.Integer, nullable=False, default=0)
+    aggiornato = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class Geocodifica(db.Model):
+    """Cache persistente luogo/provincia → coordinate (anche gli esiti negativi)."""
+    __tablename__ = "geocode_cache"
+    chiave = db.Column(db.String(220), primary_key=True)
+    lat = db.Column(db.Float)
+    lng = db.Column(db.Float)
+    trovato = db.Column(db.Boolean, nullable=False, default=False)
+    aggiornato = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# indici resi superflui da un altro: si eliminano quando il sostituto esiste
+INDICI_SOSTITUITI = {"punteggi": {"ix_punteggi_squadra_id": "uq_punteggi_squadra_gioco"}}
+
+
+def _aggiorna_schema():
+    """db.create_all() non tocca le tabelle esistenti: aggiunge colonne e indici mancanti.
+
+    Restituisce i nomi degli indici univoci non creati perché i dati esistenti hanno duplicati.
+    """
+    ispettore = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for tabella in db.metadata.sorted_tables:
+            esistenti = {c["name"] for c in ispettore.get_columns(tabella.name)}
+            for colonna in tabella.columns:
+                if colonna.name not in esistenti:
+                    tipo = colonna.type.compile(dialect=db.engine.dialect)
+                    conn.execute(db.text(f"ALTER TABLE {tabella.name} ADD COLUMN {colonna.name} {tipo}"))
+    non_creati = set()
+    for tabella in db.metadata.sorted_tables:
+        for indice in tabella.indexes:
+            try:
+                # IF NOT EXISTS: SQLite non riflette gli indici su espressioni, checkfirst non li vede
+                with db.engine.begin() as conn:
+                    conn.execute(CreateIndex(indice, if_not_exists=True))
+            except IntegrityError:
+                non_creati.add(indice.name)
+                app.logger.warning(
+                    "Indice %s non creato: la tabella %s ha righe duplicate (flask rimuovi-punteggi-duplicati)",
+                    indice.name, tabella.name,
+                )
+    for tabella, sostituiti in INDICI_SOSTITUITI.items():
+        indici = {i["name"] for i in db.inspect(db.engine).get_indexes(tabella)}
+        with db.engine.begin() as conn:
+            for vecchio, nuovo in sostituiti.items():
+                if vecchio in indici and nuovo in indici:
+                    conn.execute(db.text(f"DROP INDEX {vecchio}"))
+    return non_creati
 
-with app.app_context():
-    db.create_all()
 
 # -------------------
-# ROUTES
+# DISTANZE
 # -------------------
+RAGGIO_TERRA_KM = 6371.0088
 
-@app.route("/")
-def home():
-    classifica_generale = (
-        db.session.query(Squadra, db.func.coalesce(db.func.sum(Punteggio.punti), 0))
+
+def distanze_da_base(coordinate):
+    """Distanze haversine (km) dalla base per una lista di (lat, lng)."""
+    lat0, lng0 = map(math.radians, app.config["BASE_COORDS"])
+    cos_lat0 = math.cos(lat0)
+    radians, sin, cos, asin, sqrt = math.radians, math.sin, math.cos, math.asin, math.sqrt
+    return [
+        2 * RAGGIO_TERRA_KM * asin(sqrt(
+            sin((radians(lat) - lat0) / 2) ** 2
+            + cos_lat0 * cos(radians(lat)) * sin((radians(lng) - lng0) / 2) ** 2
+        ))
+        for lat, lng in coordinate
+    ]
+
+
+def distanza_da_base(lat, lng):
+    if lat is None or lng is None:
+        return None
+    return distanze_da_base([(lat, lng)])[0]
+
+
+def _distanza_sql():
+    """La stessa haversine come espressione SQL, per ricalcolare tutto con un solo UPDATE."""
+    lat0, lng0 = map(math.radians, app.config["BASE_COORDS"])
+    f = db.func
+    mezzo_dlat = f.sin((f.radians(Partecipante.lat) - lat0) / 2)
+    mezzo_dlng = f.sin((f.radians(Partecipante.lng) - lng0) / 2)
+    a = mezzo_dlat * mezzo_dlat + math.cos(lat0) * f.cos(f.radians(Partecipante.lat)) * mezzo_dlng * mezzo_dlng
+    return 2 * RAGGIO_TERRA_KM * f.asin(f.sqrt(a))
+
+
+def ricalcola_distanze(solo_mancanti=False):
+    """Ricalcola distanza_km in blocco; restituisce il numero di righe aggiornate."""
+    filtro = [Partecipante.lat.isnot(None), Partecipante.lng.isnot(None)]
+    if solo_mancanti:
+        filtro.append(Partecipante.distanza_km.is_(None))
+    try:
+        # Postgres e SQLite con funzioni matematiche: tutto lato database
+        risultato = db.session.execute(
+            db.update(Partecipante).where(*filtro).values(distanza_km=_distanza_sql())
+            .execution_options(synchronize_session=False)
+        )
+        aggiornate = risultato.rowcount
+    except OperationalError:
+        # SQLite senza sin/asin: calcolo in blocco in Python e executemany
+        db.session.rollback()
+        righe = db.session.query(Partecipante.id, Partecipante.lat, Partecipante.lng).filter(*filtro).all()
+        distanze = distanze_da_base([(lat, lng) for _, lat, lng in righe])
+        aggiornate = len(righe)
+        if righe:
+            db.session.execute(
+                db.update(Partecipante),
+                [{"id": id, "distanza_km": d} for (id, _, _), d in zip(righe, distanze)],
+            )
+    # partecipanti senza coordinate non hanno distanza
+    db.session.query(Partecipante).filter(
+        db.or_(Partecipante.lat.is_(None), Partecipante.lng.is_(None)), Partecipante.distanza_km.isnot(None)
+    ).update({"distanza_km": None}, synchronize_session=False)
+    if aggiornate:
+        incrementa_versione("partecipanti")
+    db.session.commit()
+    return aggiornate
+
+
+def partecipanti_piu_lontani(k=1):
+    """Primi k partecipanti per distanza dalla base (usa l'indice su distanza_km)."""
+    return (
+        Partecipante.query.filter(Partecipante.distanza_km.isnot(None))
+        .order_by(Partecipante.distanza_km.desc())
+        .limit(k)
+        .all()
+    )
+
+
+@app.cli.command("ricalcola-distanze")
+def ricalcola_distanze_comando():
+    """Ricalcola la distanza dalla base di tutti i partecipanti (es. dopo aver cambiato BASE_LAT/BASE_LNG)."""
+    click.echo(f"Distanze ricalcolate: {ricalcola_distanze()}")
+
+
+# -------------------
+# CLASSIFICA E VERSIONI
+# -------------------
+CONTATORI = ("classifica", "partecipanti", "geocoder")  # "geocoder": turno delle chiamate esterne
+CANALE_NOTIFICHE = "dovesiva_versioni"
+
+
+def incrementa_versione(nome):
+    """Segnala una modifica; va chiamata nella stessa transazione della scrittura."""
+    Contatore.query.filter_by(nome=nome).update(
+        {"valore": Contatore.valore + 1, "aggiornato": datetime.utcnow()}, synchronize_session=False
+    )
+    if db.session.get_bind().dialect.name == "postgresql":
+        # consegnata da Postgres solo al commit, a tutti i worker in ascolto
+        db.session.execute(db.text("SELECT pg_notify(:canale, :nome)"), {"canale": CANALE_NOTIFICHE, "nome": nome})
+
+
+def leggi_versioni():
+    """{nome: (valore, aggiornato)} di tutti i contatori, con una sola query."""
+    return {c.nome: (c.valore, c.aggiornato) for c in Contatore.query.all()}
+
+
+def blocca_totali(squadra_ids):
+    """Blocca le righe di team_totals delle squadre indicate fino al commit (SELECT ... FOR UPDATE).
+
+    Va chiamata prima di scrivere i punteggi: chi arriva dopo aspetta il commit dell'altro e,
+    a READ COMMITTED, le istruzioni successive all'attesa vedono anche i suoi punteggi.
+    L'ordine per squadra evita i deadlock; SQLite ignora FOR UPDATE (serializza già le scritture).
+    """
+    squadra_ids = set(squadra_ids)
+    if squadra_ids:
+        db.session.execute(
+            db.select(TotaleSquadra.squadra_id)
+            .where(TotaleSquadra.squadra_id.in_(squadra_ids))
+            .order_by(TotaleSquadra.squadra_id)
+            .with_for_update()
+        ).all()
+
+
+def aggiorna_totali(squadra_ids):
+    """Riallinea team_totals solo per le squadre indicate e incrementa la versione della classifica.
+
+    Le righe vanno bloccate con blocca_totali() prima di scrivere i punteggi.
+    """
+    squadra_ids = set(squadra_ids)
+    if squadra_ids:
+        db.session.flush()
+        somma = (
+            db.select(db.func.coalesce(db.func.sum(Punteggio.punti), 0))
+            .where(Punteggio.squadra_id == TotaleSquadra.squadra_id)
+            .scalar_subquery()
+        )
+        TotaleSquadra.query.filter(TotaleSquadra.squadra_id.in_(squadra_ids)).update(
+            {"totale": somma}, synchronize_session=False
+        )
+    incrementa_versione("classifica")
+
+
+def ricostruisci_classifica():
+    """Ricalcola da zero team_totals (primo avvio o riallineamento manuale)."""
+    TotaleSquadra.query.delete()
+    totali = (
+        db.select(Squadra.id, db.func.coalesce(db.func.sum(Punteggio.punti), 0))
         .outerjoin(Punteggio)
         .group_by(Squadra.id)
-        .order_by(db.desc(db.func.coalesce(db.func.sum(Punteggio.punti), 0)))
+    )
+    db.session.execute(db.insert(TotaleSquadra).from_select(["squadra_id", "totale"], totali))
+    incrementa_versione("classifica")
+    db.session.commit()
+
+
+def classifica_squadre():
+    return (
+        db.session.query(Squadra, TotaleSquadra.totale)
+        .join(TotaleSquadra)
+        .order_by(TotaleSquadra.totale.desc(), Squadra.nome.asc())
         .all()
     )
 
-    classifica_maneggi = (
-        db.session.query(Partecipante.maneggio, db.func.count(Partecipante.id))
-        .group_by(Partecipante.maneggio)
+
+def _inizializza_contatori():
+    nuovi = [nome for nome in CONTATORI if db.session.get(Contatore, nome) is None]
+    if not nuovi:
+        return
+    try:
+        db.session.add_all(Contatore(nome=nome) for nome in nuovi)
+        db.session.commit()
+    except IntegrityError:
+        # un altro worker li ha creati in contemporanea
+        db.session.rollback()
+        return
+    if "classifica" in nuovi:
+        ricostruisci_classifica()
+
+
+@app.cli.command("ricalcola-classifica")
+def ricalcola_classifica_comando():
+    """Ricostruisce la classifica materializzata a partire dai punteggi."""
+    ricostruisci_classifica()
+    click.echo("Classifica ricalcolata.")
+
+
+# cache in-process di pagine e aggregati: {nome: (versioni dei contatori, valore)}
+_cache = {}
+
+
+def in_cache(nome, nomi_contatori, calcola, versioni=None):
+    """Valore `nome` calcolato con calcola() e riusato finché i contatori indicati non cambiano.
+
+    `versioni` (da leggi_versioni()) evita di rileggere i contatori se il chiamante li ha già.
+    """
+    def versione(contatore):
+        if versioni is not None:
+            return versioni.get(contatore, (0, None))[0]
+        riga = db.session.get(Contatore, contatore)
+        return riga.valore if riga else 0
+
+    chiave = tuple(versione(contatore) for contatore in nomi_contatori)
+    valore = _cache.get(nome)
+    if valore is None or valore[0] != chiave:
+        valore = (chiave, calcola())
+        _cache[nome] = valore
+    return valore[1]
+
+
+def pagina_in_cache(endpoint, nomi_contatori, genera, mimetype="text/html"):
+    """Serve una pagina con ETag/Last-Modified legati ai contatori; la rigenera solo se cambiano."""
+    versioni = leggi_versioni()
+    chiave = tuple(versioni.get(nome, (0, None))[0] for nome in nomi_contatori)
+    etag = f"{endpoint}-" + "-".join(map(str, chiave))
+    date_modifica = [versioni[nome][1] for nome in nomi_contatori if nome in versioni]
+    ultima_modifica = max(date_modifica).replace(microsecond=0, tzinfo=timezone.utc) if date_modifica else None
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=ultima_modifica):
+        risposta = app.response_class(status=304)
+    else:
+        corpo = in_cache(f"pagina:{endpoint}", nomi_contatori, genera, versioni)
+        risposta = app.response_class(corpo, mimetype=mimetype)
+    risposta.set_etag(etag)
+    risposta.last_modified = ultima_modifica
+    risposta.cache_control.no_cache = True
+    return risposta
+
+
+# -------------------
+# CLASSIFICA IN DIRETTA
+# -------------------
+class NotificheClassifica:
+    """Un thread per worker osserva la versione della classifica e la distribuisce ai client SSE.
+
+    Con Postgres aspetta LISTEN/NOTIFY, altrimenti legge il contatore ogni SSE_POLLING secondi:
+    in entrambi i casi una query per cambiamento, qualunque sia il numero di schermi collegati.
+    """
+
+    def __init__(self):
+        self._condizione = threading.Condition()
+        self._versione = None
+        self._stato = {}
+        self._client = 0
+        self._thread = None
+        self._pid = None
+
+    def entra(self):
+        """Registra uno stream; False se questo worker ne ha già SSE_MAX_CLIENT aperti."""
+        with self._condizione:
+            if self._client >= app.config["SSE_MAX_CLIENT"]:
+                return False
+            self._client += 1
+            return True
+
+    def esci(self):
+        with self._condizione:
+            self._client -= 1
+
+    def client(self):
+        return self._client
+
+    def attendi(self, versione_nota, timeout):
+        """Restituisce (versione, stato) appena la versione è diversa da versione_nota o allo scadere del timeout."""
+        self._avvia()
+        with self._condizione:
+            self._condizione.wait_for(
+                lambda: self._versione is not None and self._versione != versione_nota, timeout
+            )
+            return self._versione, self._stato
+
+    def _avvia(self):
+        with self._condizione:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._lavora, name="notifiche-classifica", daemon=True)
+                self._thread.start()
+
+    def _lavora(self):
+        while True:
+            try:
+                with app.app_context():
+                    if db.engine.dialect.name == "postgresql":
+                        self._ascolta_postgres()
+                    else:
+                        while True:
+                            self._aggiorna()
+                            time.sleep(app.config["SSE_POLLING"])
+            except Exception:
+                app.logger.exception("Errore nelle notifiche della classifica, riprovo")
+                time.sleep(5)
+
+    def _ascolta_postgres(self):
+        connessione = db.engine.raw_connection()
+        connessione.detach()  # resta in autocommit: non deve tornare nel pool
+        try:
+            pg = connessione.driver_connection
+            pg.autocommit = True
+            with pg.cursor() as cursore:
+                cursore.execute(f"LISTEN {CANALE_NOTIFICHE}")
+            self._aggiorna()
+            while True:
+                # ogni tanto rilegge comunque: copre notifiche perse durante una riconnessione
+                pronti, _, _ = select.select([pg], [], [], 30)
+                if pronti:
+                    pg.poll()
+                    nomi = {n.payload for n in pg.notifies}
+                    pg.notifies.clear()
+                    if "classifica" not in nomi:
+                        continue
+                self._aggiorna()
+        finally:
+            connessione.close()
+
+    def _aggiorna(self):
+        contatore = db.session.get(Contatore, "classifica", populate_existing=True)
+        versione = contatore.valore if contatore else 0
+        if versione != self._versione:
+            stato = stato_classifica()
+            with self._condizione:
+                self._versione, self._stato = versione, stato
+                self._condizione.notify_all()
+        db.session.remove()
+
+
+notifiche_classifica = NotificheClassifica()
+
+
+def stato_classifica():
+    """La classifica nel formato degli eventi SSE: {squadra_id: {"nome", "totale"}}."""
+    return {squadra.id: {"nome": squadra.nome, "totale": totale} for squadra, totale in classifica_squadre()}
+
+
+def delta_classifica(prima, dopo):
+    """Solo le squadre cambiate (o nuove) e quelle eliminate."""
+    return {
+        "aggiornate": {id: dati for id, dati in dopo.items() if prima.get(id) != dati},
+        "rimosse": [id for id in prima if id not in dopo],
+    }
+
+
+# -------------------
+# STATISTICHE PARTECIPANTI
+# -------------------
+class Statistiche:
+    """Aggregati sui partecipanti, calcolati in un'unica query."""
+
+    def __init__(self):
+        self.totale = 0
+        self.piu_giovane = {}  # sesso → persona
+        self.piu_vecchio = None
+        self.piu_lontano = None
+        self.maneggi = []  # (maneggio, partecipanti, distanza max) per numero decrescente
+        self.province = []  # (provincia, partecipanti, distanza max, distanza media)
+
+    @property
+    def piu_giovane_f(self):
+        return self.piu_giovane.get("F")
+
+    @property
+    def piu_giovane_m(self):
+        return self.piu_giovane.get("M")
+
+    @property
+    def maneggio_top(self):
+        return self.maneggi[0][0] if self.maneggi else None
+
+    @property
+    def _maneggio_lontano(self):
+        con_distanza = [m for m in self.maneggi if m[0] and m[2] is not None]
+        return max(con_distanza, key=lambda m: m[2]) if con_distanza else None
+
+    @property
+    def maneggio_lontano(self):
+        return self._maneggio_lontano[0] if self._maneggio_lontano else None
+
+    @property
+    def distanza_lontano(self):
+        return self._maneggio_lontano[2] if self._maneggio_lontano else None
+
+    def to_dict(self):
+        def persona(p):
+            return None if p is None else dict(vars(p), nascita=p.nascita.isoformat())
+
+        return {
+            "totale": self.totale,
+            "base": app.config["BASE_NOME"],
+            "piu_giovane": {sesso: persona(p) for sesso, p in self.piu_giovane.items()},
+            "piu_vecchio": persona(self.piu_vecchio),
+            "piu_lontano": persona(self.piu_lontano),
+            "maneggi": [
+                {"maneggio": m, "partecipanti": n, "distanza_max_km": d} for m, n, d in self.maneggi
+            ],
+            "province": [
+                {"provincia": p, "partecipanti": n, "distanza_max_km": d, "distanza_media_km": media}
+                for p, n, d, media in self.province
+            ],
+        }
+
+
+def _calcola_statistiche():
+    P = Partecipante
+    f = db.func
+    finestre = db.select(
+        P.id, P.nome, P.nascita, P.sesso, P.maneggio, P.luogo, P.provincia, P.distanza_km,
+        f.row_number().over(partition_by=P.sesso, order_by=(P.nascita.desc(), P.id)).label("rn_giovane"),
+        f.row_number().over(order_by=(P.nascita.asc(), P.id)).label("rn_vecchio"),
+        f.row_number().over(order_by=(P.distanza_km.desc().nulls_last(), P.id)).label("rn_lontano"),
+        f.row_number().over(partition_by=P.maneggio, order_by=P.id).label("rn_maneggio"),
+        f.count().over(partition_by=P.maneggio).label("n_maneggio"),
+        f.max(P.distanza_km).over(partition_by=P.maneggio).label("max_maneggio"),
+        f.row_number().over(partition_by=P.provincia, order_by=P.id).label("rn_provincia"),
+        f.count().over(partition_by=P.provincia).label("n_provincia"),
+        f.max(P.distanza_km).over(partition_by=P.provincia).label("max_provincia"),
+        f.avg(P.distanza_km).over(partition_by=P.provincia).label("media_provincia"),
+        f.count().over().label("totale"),
+    ).subquery()
+    c = finestre.c
+    # solo le righe "prime" di ciascuna finestra: poche decine anche con migliaia di partecipanti
+    righe = db.session.execute(
+        db.select(finestre).where(db.or_(
+            c.rn_giovane == 1, c.rn_vecchio == 1, c.rn_lontano == 1, c.rn_maneggio == 1, c.rn_provincia == 1
+        ))
+    ).all()
+
+    stats = Statistiche()
+    for r in righe:
+        stats.totale = r.totale
+        persona = types.SimpleNamespace(
+            id=r.id, nome=r.nome, nascita=r.nascita, sesso=r.sesso, maneggio=r.maneggio,
+            luogo=r.luogo, provincia=r.provincia, distanza_km=r.distanza_km,
+        )
+        if r.rn_giovane == 1:
+            stats.piu_giovane[r.sesso] = persona
+        if r.rn_vecchio == 1:
+            stats.piu_vecchio = persona
+        if r.rn_lontano == 1 and r.distanza_km is not None:
+            stats.piu_lontano = persona
+        if r.rn_maneggio == 1:
+            stats.maneggi.append((r.maneggio, r.n_maneggio, r.max_maneggio))
+        if r.rn_provincia == 1:
+            stats.province.append((r.provincia, r.n_provincia, r.max_provincia, r.media_provincia))
+    stats.maneggi.sort(key=lambda m: (-m[1], m[0] or ""))
+    stats.province.sort(key=lambda p: (-p[1], p[0] or ""))
+    return stats
+
+
+def statistiche_partecipanti():
+    """Statistiche in cache, ricalcolate quando cambia la versione "partecipanti"."""
+    return in_cache("statistiche", ("partecipanti",), _calcola_statistiche)
+
+
+# -------------------
+# TABELLONE (SQUADRE × GIOCHI)
+# -------------------
+class Tabellone:
+    """Matrice completa dei risultati con posizioni per gioco e in classifica generale."""
+
+    def __init__(self, giochi, righe):
+        self.giochi = giochi  # [{"id", "nome"}] in ordine di inserimento
+        self.righe = righe  # [{"squadra_id", "nome", "posizione", "totale", "celle": {gioco_id: cella}}]
+
+    def classifica_gioco(self, gioco_id):
+        """Squadre ordinate per posizione nel gioco; chi non ha punteggio va in fondo."""
+        righe = [(r, r["celle"][gioco_id]) for r in self.righe]
+        return sorted(righe, key=lambda rc: (rc[1]["posizione"] is None, rc[1]["posizione"] or 0, rc[0]["nome"]))
+
+    def to_dict(self):
+        return {
+            "giochi": self.giochi,
+            "squadre": [
+                dict(r, celle={str(g): c for g, c in r["celle"].items()}) for r in self.righe
+            ],
+        }
+
+
+def _posizioni(valori):
+    """Posizioni "a pari merito" (1, 1, 3) per valori decrescenti."""
+    posizioni, precedente = [], None
+    for i, valore in enumerate(valori, start=1):
+        if valore != precedente:
+            posizione, precedente = i, valore
+        posizioni.append(posizione)
+    return posizioni
+
+
+def _calcola_tabellone():
+    f = db.func
+    senza_punti = db.case((Punteggio.punti.is_(None), 1), else_=0)
+    righe = db.session.execute(
+        db.select(
+            Squadra.id, Squadra.nome, Gioco.id, Gioco.nome, Punteggio.punti,
+            f.rank().over(partition_by=Gioco.id, order_by=(senza_punti, Punteggio.punti.desc())),
+            f.count().over(partition_by=(Gioco.id, Punteggio.punti)),
+            f.sum(f.coalesce(Punteggio.punti, 0)).over(partition_by=Squadra.id),
+        )
+        .select_from(Squadra)
+        .join(Gioco, db.true())
+        .outerjoin(Punteggio, db.and_(Punteggio.squadra_id == Squadra.id, Punteggio.gioco_id == Gioco.id))
+        .order_by(Squadra.id, Gioco.id)
+    ).all()
+
+    giochi, squadre = {}, {}
+    for squadra_id, squadra_nome, gioco_id, gioco_nome, punti, posizione, stessi_punti, totale in righe:
+        giochi.setdefault(gioco_id, {"id": gioco_id, "nome": gioco_nome})
+        riga = squadre.setdefault(
+            squadra_id, {"squadra_id": squadra_id, "nome": squadra_nome, "totale": totale, "celle": {}}
+        )
+        riga["celle"][gioco_id] = {
+            "punti": punti,
+            "posizione": posizione if punti is not None else None,
+            "pari_merito": punti is not None and stessi_punti > 1,
+        }
+    if not righe:
+        # senza squadre o senza giochi la join è vuota: servono comunque le colonne e le righe
+        giochi = {id: {"id": id, "nome": nome} for id, nome in db.session.query(Gioco.id, Gioco.nome)}
+        squadre = {
+            id: {"squadra_id": id, "nome": nome, "totale": 0, "celle": {}}
+            for id, nome in db.session.query(Squadra.id, Squadra.nome)
+        }
+    righe = sorted(squadre.values(), key=lambda r: (-r["totale"], r["nome"]))
+    for riga, posizione in zip(righe, _posizioni([r["totale"] for r in righe])):
+        riga["posizione"] = posizione
+    return Tabellone(sorted(giochi.values(), key=lambda g: g["id"]), righe)
+
+
+def tabellone():
+    """Tabellone in cache, ricalcolato quando cambia la versione "classifica"."""
+    return in_cache("tabellone", ("classifica",), _calcola_tabellone)
+
+
+with app.app_context():
+    db.create_all()
+    # senza l'indice univoco (database con punteggi duplicati) l'upsert non è possibile
+    upsert_punteggi = "uq_punteggi_squadra_gioco" not in _aggiorna_schema()
+    _inizializza_contatori()
+    # righe con coordinate ma senza distanza (es. colonna appena aggiunta)
+    ricalcola_distanze(solo_mancanti=True)
+
+# -------------------
+# GEOCODIFICA
+# -------------------
+class GeocoderNominatim:
+    intervallo = 1.1  # policy Nominatim: max 1 richiesta al secondo (con un margine)
+
+    def __init__(self):
+        self._geolocator = Nominatim(user_agent="dovesiva", timeout=app.config["GEOCODE_TIMEOUT"])
+
+    def geocode(self, query):
+        location = self._geolocator.geocode(query)
+        return (location.latitude, location.longitude) if location else None
+
+
+class GeocoderFinto:
+    """Backend locale per test e benchmark: coordinate deterministiche in Italia, nessuna rete."""
+    intervallo = 0.0
+
+    def geocode(self, query):
+        h = zlib.crc32(query.lower().encode())
+        return 37.0 + (h % 9000) / 1000, 7.0 + (h // 9000 % 11000) / 1000
+
+
+def get_geocoder():
+    geocoder = app.config.get("GEOCODER")
+    if geocoder is None:
+        backend = app.config["GEOCODER_BACKEND"]
+        if backend == "nominatim":
+            geocoder = GeocoderNominatim()
+        elif backend == "finto":
+            geocoder = GeocoderFinto()
+        else:
+            modulo, _, classe = backend.partition(":")
+            geocoder = getattr(importlib.import_module(modulo), classe)()
+        app.config["GEOCODER"] = geocoder
+    return geocoder
+
+
+def _normalizza(testo):
+    testo = unicodedata.normalize("NFKD", testo)
+    testo = "".join(c for c in testo if not unicodedata.combining(c))
+    return re.sub(r"[\W_]+", " ", testo.lower()).strip()
+
+
+def chiave_geocodifica(luogo, provincia):
+    """Chiave di cache: "sasso marconi|bo" per "Sasso  Marconi", "Bo"."""
+    if not luogo or not provincia:
+        return None
+    luogo, provincia = _normalizza(luogo), _normalizza(provincia)
+    if not luogo or not provincia:
+        return None
+    return f"{luogo}|{provincia}"
+
+
+def _voce_valida(voce):
+    if voce is None:
+        return False
+    if voce.trovato:
+        return True
+    ttl = timedelta(hours=app.config["GEOCODE_TTL_NEGATIVO_ORE"])
+    return voce.aggiornato > datetime.utcnow() - ttl
+
+
+def _consulta_cache(voce):
+    """_voce_valida() che registra anche hit/miss della cache."""
+    valida = _voce_valida(voce)
+    metriche.incrementa("dovesiva_geocode_cache_totale", esito="hit" if valida else "miss")
+    return valida
+
+
+def _applica_coordinate(chiave, lat, lng):
+    Partecipante.query.filter_by(geo_chiave=chiave).update(
+        {"lat": lat, "lng": lng, "distanza_km": distanza_da_base(lat, lng)}, synchronize_session=False
+    )
+    incrementa_versione("partecipanti")
+
+
+def _attendi_turno_geocoder():
+    """Al più una chiamata al geocoder ogni `intervallo` secondi, sommando tutti i processi.
+
+    Il turno è la data del contatore "geocoder": lo sposta avanti un UPDATE condizionato,
+    che riesce a un solo processo alla volta; gli altri aspettano il turno successivo.
+    """
+    intervallo = timedelta(seconds=get_geocoder().intervallo)
+    if not intervallo:
+        return
+    while True:
+        adesso = datetime.utcnow()
+        prenotato = db.session.execute(
+            db.update(Contatore)
+            .where(Contatore.nome == "geocoder", Contatore.aggiornato <= adesso - intervallo)
+            .values(valore=Contatore.valore + 1, aggiornato=adesso)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if prenotato:
+            return
+        turno = db.session.get(Contatore, "geocoder")
+        if turno is None:
+            return
+        time.sleep(max((turno.aggiornato + intervallo - adesso).total_seconds(), 0.05))
+
+
+def geocodifica(chiave, query):
+    """Interroga il backend, salva l'esito in cache e aggiorna i partecipanti con quella chiave.
+
+    Le eccezioni del backend (timeout, rate limit) vengono propagate al chiamante.
+    """
+    richiesta = datetime.utcnow()
+    _attendi_turno_geocoder()
+    voce = db.session.get(Geocodifica, chiave, populate_existing=True)
+    if voce is not None and voce.aggiornato >= richiesta:
+        # risolta da un altro processo mentre si aspettava il turno
+        return (voce.lat, voce.lng) if voce.trovato else None
+    inizio = time.perf_counter()
+    try:
+        coords = get_geocoder().geocode(query)
+    except Exception:
+        metriche.incrementa("dovesiva_geocoder_chiamate_totale", esito="errore")
+        raise
+    finally:
+        metriche.osserva("dovesiva_geocoder_secondi", time.perf_counter() - inizio)
+    metriche.incrementa("dovesiva_geocoder_chiamate_totale", esito="trovato" if coords else "non_trovato")
+    if voce is None:
+        voce = Geocodifica(chiave=chiave)
+        db.session.add(voce)
+    voce.lat, voce.lng = coords or (None, None)
+    voce.trovato = coords is not None
+    voce.aggiornato = datetime.utcnow()
+    if coords:
+        _applica_coordinate(chiave, *coords)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # un altro worker ha salvato la stessa chiave nel frattempo
+        db.session.rollback()
+        if coords:
+            _applica_coordinate(chiave, *coords)
+            db.session.commit()
+    return coords
+
+
+def geocodifica_con_retry(chiave, query):
+    tentativi = app.config["GEOCODE_TENTATIVI"]
+    for tentativo in range(tentativi):
+        try:
+            return geocodifica(chiave, query)
+        except Exception:
+            db.session.rollback()
+            if tentativo == tentativi - 1:
+                app.logger.warning("Geocodifica fallita per %r", query)
+                return None
+            time.sleep(min(2 ** tentativo, 60))
+
+
+def localita_da_geocodificare(riprova_negativi=False):
+    """(chiave, query) delle località con partecipanti senza coordinate e senza esito valido in cache."""
+    scadenza = datetime.utcnow() - timedelta(hours=app.config["GEOCODE_TTL_NEGATIVO_ORE"])
+    query = (
+        db.session.query(
+            Partecipante.geo_chiave, db.func.min(Partecipante.luogo), db.func.min(Partecipante.provincia)
+        )
+        .outerjoin(Geocodifica, Geocodifica.chiave == Partecipante.geo_chiave)
+        .filter(Partecipante.geo_chiave.isnot(None), Partecipante.lat.is_(None))
+    )
+    if not riprova_negativi:
+        query = query.filter(db.or_(
+            Geocodifica.chiave.is_(None), Geocodifica.trovato, Geocodifica.aggiornato <= scadenza
+        ))
+    return [
+        (chiave, f"{luogo}, {provincia}, Italia")
+        for chiave, luogo, provincia in query.group_by(Partecipante.geo_chiave)
+    ]
+
+
+def geocodifica_localita(chiave, query, riprova_negativi=False):
+    """Coordinate di una località: dalla cache se c'è un esito valido, altrimenti dal geocoder."""
+    voce = db.session.get(Geocodifica, chiave, populate_existing=True)
+    if voce is not None and voce.trovato:
+        _applica_coordinate(chiave, voce.lat, voce.lng)
+        db.session.commit()
+        return voce.lat, voce.lng
+    if not riprova_negativi and _consulta_cache(voce):
+        return None
+    return geocodifica_con_retry(chiave, query)
+
+
+class CodaGeocodifica:
+    """Thread per processo che riempie lat/lng in background.
+
+    Il lavoro da fare sta nel database (partecipanti con geo_chiave ma senza coordinate), quindi
+    un riavvio non perde nulla: accoda() sveglia il thread, che comunque ricontrolla ogni
+    GEOCODE_RISCANSIONE secondi. Il limite di chiamate vale per tutti i processi insieme
+    (_attendi_turno_geocoder); ognuno scorre le località in ordine casuale per non
+    contendersi le stesse.
+    """
+
+    def __init__(self):
+        self._sveglia = threading.Event()
+        self._lock = threading.Lock()
+        self._in_attesa = 0
+        self._thread = None
+        self._pid = None
+
+    def avvia(self):
+        with self._lock:
+            # dopo un fork (gunicorn --preload) il thread del padre non esiste più
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._lavora, name="geocodifica", daemon=True)
+                self._thread.start()
+
+    def accoda(self):
+        self.avvia()
+        self._sveglia.set()
+
+    def lunghezza(self):
+        """Località in attesa di geocodifica in questo processo."""
+        return self._in_attesa
+
+    def _lavora(self):
+        while True:
+            try:
+                with app.app_context():
+                    localita = localita_da_geocodificare()
+                    random.shuffle(localita)
+                    self._in_attesa = len(localita)
+                    for chiave, query in localita:
+                        geocodifica_localita(chiave, query)
+                        self._in_attesa -= 1
+            except Exception:
+                app.logger.exception("Errore nella coda di geocodifica")
+            self._in_attesa = 0
+            self._sveglia.wait(app.config["GEOCODE_RISCANSIONE"])
+            self._sveglia.clear()
+
+
+coda_geocodifica = CodaGeocodifica()
+
+
+@app.before_request
+def _avvia_coda_geocodifica():
+    # riprende anche le località lasciate in sospeso da un worker precedente
+    if app.config["GEOCODE_ASYNC"]:
+        coda_geocodifica.avvia()
+
+
+def richiedi_coordinate(partecipante):
+    """Assegna lat/lng dalla cache.
+
+    Se serve una chiamata al geocoder restituisce (chiave, query), da passare ad
+    accoda_geocodifica() dopo il commit.
+    """
+    chiave = chiave_geocodifica(partecipante.luogo, partecipante.provincia)
+    partecipante.geo_chiave = chiave
+    partecipante.lat = partecipante.lng = partecipante.distanza_km = None
+    if chiave is None:
+        return None
+    voce = db.session.get(Geocodifica, chiave)
+    if _consulta_cache(voce):
+        if voce.trovato:
+            partecipante.lat, partecipante.lng = voce.lat, voce.lng
+            partecipante.distanza_km = distanza_da_base(voce.lat, voce.lng)
+        return None
+    return chiave, f"{partecipante.luogo}, {partecipante.provincia}, Italia"
+
+
+def accoda_geocodifica(richiesta):
+    if richiesta is None:
+        return
+    if app.config["GEOCODE_ASYNC"]:
+        coda_geocodifica.accoda()  # la località è già nel database: basta svegliare il thread
+    else:
+        geocodifica_con_retry(*richiesta)
+
+
+@app.cli.command("geocodifica-mancanti")
+@click.option("--riprova-negativi", is_flag=True, help="Ignora la cache degli esiti negativi.")
+def geocodifica_mancanti(riprova_negativi):
+    """Geocodifica (in modo sincrono) i partecipanti senza coordinate."""
+    # partecipanti inseriti prima della cache: calcola la chiave
+    senza_chiave = (
+        db.session.query(Partecipante.id, Partecipante.luogo, Partecipante.provincia)
+        .filter(Partecipante.geo_chiave.is_(None), Partecipante.luogo.isnot(None))
         .all()
     )
+    aggiornamenti = [
+        {"id": id, "geo_chiave": chiave_geocodifica(luogo, provincia)}
+        for id, luogo, provincia in senza_chiave
+    ]
+    if aggiornamenti:
+        db.session.execute(db.update(Partecipante), aggiornamenti)
+        db.session.commit()
 
-    youngest_f = (
-        Partecipante.query.filter_by(sesso="F").order_by(Partecipante.nascita.desc()).first()
+    mancanti = localita_da_geocodificare(riprova_negativi)
+    trovati = sum(
+        1 for chiave, query in mancanti if geocodifica_localita(chiave, query, riprova_negativi)
     )
-    youngest_m = (
-        Partecipante.query.filter_by(sesso="M").order_by(Partecipante.nascita.desc()).first()
+    click.echo(f"Località senza coordinate: {len(mancanti)}, geocodificate: {trovati}")
+
+# -------------------
+# PAGINAZIONE
+# -------------------
+PER_PAGINA = 50
+
+
+def _codifica_cursore(valori):
+    return base64.urlsafe_b64encode(json.dumps(valori).encode()).decode()
+
+
+def _decodifica_cursore(testo, chiave):
+    """Valori del cursore, o None se non è valido per le colonne `chiave` (numero e tipi)."""
+    try:
+        valori = json.loads(base64.urlsafe_b64decode(testo.encode()))
+    except (ValueError, TypeError):
+        return None
+    # un tipo sbagliato (es. ["x"] su un id) su PostgreSQL sarebbe un DataError, cioè un 500
+    if not isinstance(valori, list) or len(valori) != len(chiave) or any(
+        type(v) is not c.type.python_type for v, c in zip(valori, chiave)
+    ):
+        return None
+    return valori
+
+
+def pagina_keyset(query, chiave):
+    """Pagina di `query` ordinata per le colonne `chiave` (l'ultima deve essere univoca).
+
+    Legge ?dopo= / ?prima= dalla richiesta e restituisce (righe, cursore_precedente, cursore_successivo):
+    ogni pagina costa una query con LIMIT, senza OFFSET.
+    """
+    per_pagina = max(1, min(request.args.get("per", PER_PAGINA, type=int), 200))
+    dopo = _decodifica_cursore(request.args.get("dopo", ""), chiave)
+    prima = None if dopo else _decodifica_cursore(request.args.get("prima", ""), chiave)
+    cursore = dopo or prima
+    if cursore is not None:
+        confronto = db.tuple_(*chiave) > db.tuple_(*cursore) if dopo else db.tuple_(*chiave) < db.tuple_(*cursore)
+        query = query.filter(confronto)
+    ordine = [c.desc() for c in chiave] if prima else [c.asc() for c in chiave]
+    righe = query.order_by(*ordine).limit(per_pagina + 1).all()
+    altre = len(righe) > per_pagina
+    righe = righe[:per_pagina]
+    if prima:
+        righe.reverse()
+
+    def cursore_di(riga):
+        return _codifica_cursore([getattr(riga, c.key) for c in chiave])
+
+    indietro = righe and ((prima and altre) or (not prima and cursore is not None))
+    avanti = righe and ((not prima and altre) or (prima and cursore is not None))
+    return (
+        righe,
+        cursore_di(righe[0]) if indietro else None,
+        cursore_di(righe[-1]) if avanti else None,
     )
-    oldest = Partecipante.query.order_by(Partecipante.nascita.asc()).first()
-
-    # distanza max (da Bologna come base)
-    base_coords = (44.4949, 11.3426)
-    farthest = None
-    partecipanti = Partecipante.query.filter(Partecipante.lat.isnot(None), Partecipante.lng.isnot(None)).all()
-    if partecipanti:
-        distanze = [
-            (p, geodesic(base_coords, (p.lat, p.lng)).km) for p in partecipanti if p.lat and p.lng
-        ]
-        if distanze:
-            farthest = max(distanze, key=lambda x: x[1])
+
+
+def _filtri_partecipanti(query):
+    """Ricerca e filtri comuni alla pagina e all'API dei partecipanti."""
+    q = request.args.get("q", "").strip()
+    if q:
+        query = query.filter(Partecipante.nome.ilike(f"%{q}%"))
+    squadra_id = request.args.get("squadra_id", type=int)
+    if squadra_id:
+        query = query.filter(Partecipante.squadra_id == squadra_id)
+    for campo in ("maneggio", "provincia"):
+        valore = request.args.get(campo, "").strip()
+        if valore:
+            query = query.filter(db.func.lower(getattr(Partecipante, campo)) == valore.lower())
+    return query
+
+
+# -------------------
+# ROUTES
+# -------------------
+
+@app.route("/")
+def home():
+    # i telefoni ricaricano di continuo: 304 se classifica e partecipanti non sono cambiati
+    return pagina_in_cache("home", ("classifica", "partecipanti"), _render_home)
+
+
+def _render_home():
+    classifica_generale = classifica_squadre()
+
+    stats = statistiche_partecipanti()
+    farthest = (stats.piu_lontano, stats.piu_lontano.distanza_km) if stats.piu_lontano else None
 
     return render_template(
         "home.html",
+        polling_ms=int(app.config["CLASSIFICA_POLLING"] * 1000),
         classifica_generale=classifica_generale,
-        classifica_maneggi=classifica_maneggi,
-        youngest_f=youngest_f,
-        youngest_m=youngest_m,
-        oldest=oldest,
+        classifica_maneggi=[(m, n) for m, n, _ in stats.maneggi],
+        youngest_f=stats.piu_giovane_f,
+        youngest_m=stats.piu_giovane_m,
+        oldest=stats.piu_vecchio,
         farthest=farthest,
     )
 
+
+@app.route("/statistiche")
+def statistiche():
+    return render_template(
+        "statistiche.html", stats=statistiche_partecipanti(), base_nome=app.config["BASE_NOME"]
+    )
+
+
+@app.route("/stream/classifica")
+def stream_classifica():
+    """Server-Sent Events: la classifica completa alla connessione, poi solo le differenze.
+
+    Ogni stream resta aperto finché lo schermo è acceso: servono worker gevent (Procfile),
+    e oltre SSE_MAX_CLIENT stream per worker si risponde 503 e la pagina passa al polling.
+    """
+    if not notifiche_classifica.entra():
+        return Response(
+            "Troppi schermi collegati: usa /api/classifica", status=503,
+            headers={"Retry-After": str(int(app.config["CLASSIFICA_POLLING"]))},
+        )
+
+    def evento(tipo, versione, dati):
+        return f"event: {tipo}\nid: {versione}\ndata: {json.dumps(dati)}\n\n"
+
+    def genera():
+        versione, stato = notifiche_classifica.attendi(None, app.config["SSE_KEEPALIVE"])
+        yield "retry: 3000\n\n"
+        yield evento("classifica", versione, {"versione": versione, "squadre": stato})
+        while True:
+            nuova, nuovo_stato = notifiche_classifica.attendi(versione, app.config["SSE_KEEPALIVE"])
+            if nuova == versione:
+                yield ": keepalive\n\n"
+                continue
+            delta = delta_classifica(stato, nuovo_stato)
+            delta["versione"] = nuova
+            yield evento("delta", nuova, delta)
+            versione, stato = nuova, nuovo_stato
+
+    risposta = Response(
+        genera(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    risposta.call_on_close(notifiche_classifica.esci)
+    return risposta
+
+
+@app.route("/api/classifica")
+def api_classifica():
+    """La stessa classifica degli eventi SSE, per gli schermi che non possono tenere uno stream."""
+
+    def genera():
+        contatore = db.session.get(Contatore, "classifica")
+        return json.dumps({"versione": contatore.valore if contatore else 0, "squadre": stato_classifica()})
+
+    return pagina_in_cache("api_classifica", ("classifica",), genera, mimetype="application/json")
+
+
+@app.route("/metrics")
+def metrics():
+    indicatori = [
+        ("dovesiva_coda_geocodifica", "Località in attesa di geocodifica in questo processo.",
+         coda_geocodifica.lunghezza()),
+        ("dovesiva_client_sse", "Stream SSE della classifica aperti in questo processo.",
+         notifiche_classifica.client()),
+    ]
+    return Response(metriche.esporta(indicatori), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/statistiche")
+def api_statistiche():
+    dati = statistiche_partecipanti().to_dict()
+    k = min(request.args.get("lontani", 10, type=int), 100)
+    dati["piu_lontani"] = [
+        {"id": p.id, "nome": p.nome, "luogo": p.luogo, "provincia": p.provincia, "distanza_km": p.distanza_km}
+        for p in partecipanti_piu_lontani(k)
+    ]
+    return jsonify(dati)
+
 # -------------------
 # SQUADRE
 # -------------------
@@ -121,17 +1399,23 @@ def squadre():
     if request.method == "POST":
         nome = request.form["nome"].strip()
         if nome:
-            db.session.add(Squadra(nome=nome))
+            db.session.add(Squadra(nome=nome, totale=TotaleSquadra(totale=0)))
+            incrementa_versione("classifica")
             db.session.commit()
         return redirect(url_for("squadre"))
-    squadre = Squadra.query.order_by(Squadra.nome.asc()).all()
-    return render_template("squadre.html", squadre=squadre)
+    query = Squadra.query
+    q = request.args.get("q", "").strip()
+    if q:
+        query = query.filter(Squadra.nome.ilike(f"%{q}%"))
+    squadre, prima, dopo = pagina_keyset(query, (Squadra.nome, Squadra.id))
+    return render_template("squadre.html", squadre=squadre, q=q, prima=prima, dopo=dopo)
 
 
 @app.route("/squadre/<int:id>/delete", methods=["POST"])
 def delete_squadra(id):
     squadra = Squadra.query.get_or_404(id)
-    db.session.delete(squadra)
+    db.session.delete(squadra)  # insieme ai suoi punteggi e al totale
+    incrementa_versione("classifica")
     db.session.commit()
     return redirect(url_for("squadre"))
 
@@ -140,7 +1424,6 @@ def delete_squadra(id):
 # -------------------
 @app.route("/partecipanti", methods=["GET", "POST"])
 def partecipanti():
-    squadre = Squadra.query.all()
     if request.method == "POST":
         nome = request.form["nome"]
         nascita = date.fromisoformat(request.form["nascita"])
@@ -151,15 +1434,6 @@ def partecipanti():
         squadra_id = request.form.get("squadra_id")
         squadra_id = int(squadra_id) if squadra_id else None
 
-        lat, lng = None, None
-        if luogo and provincia:
-            try:
-                location = geolocator.geocode(f"{luogo}, {provincia}, Italia")
-                if location:
-                    lat, lng = location.latitude, location.longitude
-            except Exception:
-                pass
-
         p = Partecipante(
             nome=nome,
             nascita=nascita,
@@ -168,15 +1442,44 @@ def partecipanti():
             provincia=provincia,
             maneggio=maneggio,
             squadra_id=squadra_id,
-            lat=lat,
-            lng=lng,
         )
+        # coordinate dalla cache, altrimenti geocodifica in background
+        richiesta = richiedi_coordinate(p)
         db.session.add(p)
+        incrementa_versione("partecipanti")
         db.session.commit()
-        return redirect(url_for("partecipanti"))
+        accoda_geocodifica(richiesta)
+        return redirect(url_for("partecipanti", **request.args))
+
+    # la squadra di ogni riga arriva con la stessa query (niente lazy load per riga)
+    query = _filtri_partecipanti(Partecipante.query.options(joinedload(Partecipante.squadra)))
+    partecipanti, prima, dopo = pagina_keyset(query, (Partecipante.nome, Partecipante.id))
+    squadre = db.session.query(Squadra.id, Squadra.nome).order_by(Squadra.nome.asc()).all()
+    filtri = {k: v for k, v in request.args.items() if k in ("q", "squadra_id", "maneggio", "provincia") and v}
+    return render_template(
+        "partecipanti.html",
+        partecipanti=partecipanti,
+        squadre=squadre,
+        filtri=filtri,
+        prima=prima,
+        dopo=dopo,
+    )
+
 
-    partecipanti = Partecipante.query.all()
-    return render_template("partecipanti.html", partecipanti=partecipanti, squadre=squadre)
+@app.route("/api/partecipanti")
+def api_partecipanti():
+    """Elenco filtrato in JSON, trasmesso a blocchi senza caricare tutte le righe."""
+    query = _filtri_partecipanti(
+        db.select(
+            Partecipante.id, Partecipante.nome, Partecipante.nascita, Partecipante.sesso,
+            Partecipante.luogo, Partecipante.provincia, Partecipante.maneggio,
+            Partecipante.squadra_id, Squadra.nome.label("squadra"),
+            Partecipante.lat, Partecipante.lng, Partecipante.distanza_km,
+        )
+        .outerjoin(Squadra, Partecipante.squadra_id == Squadra.id)
+        .order_by(Partecipante.nome, Partecipante.id)
+    )
+    return Response(stream_with_context(stream_json(query)), mimetype="application/json")
 
 
 @app.route("/partecipanti/<int:id>/edit", methods=["POST"])
@@ -185,21 +1488,28 @@ def edit_partecipante(id):
     partecipante.nome = request.form["nome"].strip()
     partecipante.nascita = date.fromisoformat(request.form["nascita"])
     partecipante.sesso = request.form["sesso"]
+    luogo_precedente = (partecipante.luogo, partecipante.provincia)
     partecipante.luogo = request.form.get("luogo")
     partecipante.provincia = request.form.get("provincia")
     partecipante.maneggio = request.form.get("maneggio")
     squadra_id = request.form.get("squadra_id")
     partecipante.squadra_id = int(squadra_id) if squadra_id else None
+    richiesta = None
+    if (partecipante.luogo, partecipante.provincia) != luogo_precedente or partecipante.geo_chiave is None:
+        richiesta = richiedi_coordinate(partecipante)
+    incrementa_versione("partecipanti")
     db.session.commit()
-    return redirect(url_for("partecipanti"))
+    accoda_geocodifica(richiesta)
+    return redirect(url_for("partecipanti", **request.args))
 
 
 @app.route("/partecipanti/<int:id>/delete", methods=["POST"])
 def delete_partecipante(id):
     partecipante = Partecipante.query.get_or_404(id)
     db.session.delete(partecipante)
+    incrementa_versione("partecipanti")
     db.session.commit()
-    return redirect(url_for("partecipanti"))
+    return redirect(url_for("partecipanti", **request.args))
 
 # -------------------
 # GIOCHI
@@ -210,16 +1520,22 @@ def giochi():
         nome = request.form["nome"].strip()
         if nome:
             db.session.add(Gioco(nome=nome))
+            incrementa_versione("classifica")
             db.session.commit()
         return redirect(url_for("giochi"))
-    giochi = Gioco.query.all()
-    return render_template("giochi.html", giochi=giochi)
+    query = Gioco.query
+    q = request.args.get("q", "").strip()
+    if q:
+        query = query.filter(Gioco.nome.ilike(f"%{q}%"))
+    giochi, prima, dopo = pagina_keyset(query, (Gioco.id,))
+    return render_template("giochi.html", giochi=giochi, q=q, prima=prima, dopo=dopo)
 
 
 @app.route("/giochi/<int:id>/edit", methods=["POST"])
 def edit_gioco(id):
     gioco = Gioco.query.get_or_404(id)
     gioco.nome = request.form["nome"].strip()
+    incrementa_versione("classifica")
     db.session.commit()
     return redirect(url_for("giochi"))
 
@@ -227,19 +1543,99 @@ def edit_gioco(id):
 @app.route("/giochi/<int:id>/delete", methods=["POST"])
 def delete_gioco(id):
     gioco = Gioco.query.get_or_404(id)
-    db.session.delete(gioco)
+    squadre_coinvolte = [p.squadra_id for p in gioco.punteggi]
+    blocca_totali(squadre_coinvolte)
+    db.session.delete(gioco)  # insieme ai suoi punteggi
+    aggiorna_totali(squadre_coinvolte)
     db.session.commit()
     return redirect(url_for("giochi"))
 
+@app.route("/giochi/<int:id>", methods=["GET", "POST"])
+def dettaglio_gioco(id):
+    gioco = Gioco.query.get_or_404(id)
+    errore = None
+    if request.method == "POST":
+        squadra_id = request.form.get("squadra_id", type=int)
+        try:
+            punti = leggi_punti(request.form.get("punti"))
+            if punti is None:
+                raise ValueError("punteggio mancante")
+            if db.session.get(Squadra, squadra_id) is None:
+                raise ValueError("squadra inesistente")
+        except ValueError as e:
+            errore = str(e)
+        else:
+            salva_punteggi([{"squadra_id": squadra_id, "gioco_id": gioco.id, "punti": punti}])
+            db.session.commit()
+            return redirect(url_for("dettaglio_gioco", id=gioco.id))
+    righe = tabellone().classifica_gioco(gioco.id)
+    return render_template(
+        "dettaglio_gioco.html", gioco=gioco, righe=righe, errore=errore
+    ), (400 if errore else 200)
+
+
+@app.route("/giochi/<int:gioco_id>/punteggio/<int:squadra_id>/delete", methods=["POST"])
+def delete_punteggio(gioco_id, squadra_id):
+    punteggio = Punteggio.query.filter_by(gioco_id=gioco_id, squadra_id=squadra_id).first_or_404()
+    blocca_totali([squadra_id])
+    db.session.delete(punteggio)
+    aggiorna_totali([squadra_id])
+    db.session.commit()
+    return redirect(url_for("dettaglio_gioco", id=gioco_id))
+
+# -------------------
+# TABELLONE
+# -------------------
+@app.route("/tabellone")
+def pagina_tabellone():
+    return render_template("tabellone.html", tabellone=tabellone())
+
+
+@app.route("/tabellone.json")
+def tabellone_json():
+    return jsonify(tabellone().to_dict())
+
+
+@app.route("/tabellone.csv")
+def tabellone_csv():
+    dati = tabellone()
+
+    def genera():
+        buffer = io.StringIO()
+        scrittore = csv.writer(buffer)
+        scrittore.writerow(["posizione", "squadra"] + [g["nome"] for g in dati.giochi] + ["totale"])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        for riga in dati.righe:
+            scrittore.writerow(
+                [riga["posizione"], riga["nome"]]
+                + [riga["celle"][g["id"]]["punti"] for g in dati.giochi]
+                + [riga["totale"]]
+            )
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    return Response(
+        genera(), mimetype="text/csv", headers={"Content-Disposition": "attachment; filename=tabellone.csv"}
+    )
+
 # -------------------
 # DETTAGLIO SQUADRA + PUNTEGGI
 # -------------------
 @app.route("/squadre/<int:id>")
 def dettaglio_squadra(id):
-    squadra = Squadra.query.get_or_404(id)
+    return _render_dettaglio_squadra(Squadra.query.get_or_404(id))
+
+
+def _render_dettaglio_squadra(squadra, errore=None):
+    """`errore` è (gioco_id, messaggio) quando un punteggio inviato non è stato salvato."""
     giochi = Gioco.query.all()
     punteggi = {p.gioco_id: p for p in squadra.punteggi}
-    return render_template("dettaglio_squadra.html", squadra=squadra, giochi=giochi, punteggi=punteggi)
+    return render_template(
+        "dettaglio_squadra.html", squadra=squadra, giochi=giochi, punteggi=punteggi, errore=errore
+    ), (400 if errore else 200)
 
 
 @app.route("/squadre/<int:id>/punteggio/<int:gioco_id>", methods=["POST"])
@@ -247,31 +1643,462 @@ def salva_punteggio(id, gioco_id):
     squadra = Squadra.query.get_or_404(id)
     gioco = Gioco.query.get_or_404(gioco_id)
 
-    # caso speciale: Quiz → somma 5 domande
-    if gioco.nome.lower() == "quiz":
-        totale = 0.0
-        for i in range(1, 6):
-            val = request.form.get(f"quiz_{i}")
-            try:
-                totale += float(val) if val else 0.0
-            except ValueError:
-                pass
-        punti = totale
+    # caso speciale: Quiz → somma delle domande
+    if is_quiz(gioco):
+        dato = [request.form.get(f"quiz_{i}") for i in range(1, DOMANDE_QUIZ + 1)]
     else:
+        dato = request.form.get("punti")
+    valori, errori = valida_griglia([(squadra.id, gioco.id, dato)], {squadra.id: squadra}, {gioco.id: gioco})
+    errore = errori.get((squadra.id, gioco.id)) or (None if valori else "punteggio mancante")
+    if errore:
+        return _render_dettaglio_squadra(squadra, errore=(gioco.id, errore))
+
+    salva_punteggi(valori)
+    db.session.commit()
+
+    return redirect(url_for("dettaglio_squadra", id=squadra.id))
+
+# -------------------
+# INSERIMENTO PUNTEGGI IN BLOCCO
+# -------------------
+DOMANDE_QUIZ = 5
+BLOCCO_UPSERT = 500
+
+
+def is_quiz(gioco):
+    return gioco.nome.lower() == "quiz"
+
+
+def salva_punteggi(valori):
+    """Upsert di {squadra_id, gioco_id, punti} con INSERT ... ON CONFLICT; il commit è del chiamante."""
+    if not valori:
+        return
+    blocca_totali(v["squadra_id"] for v in valori)
+    dialetto = db.session.get_bind().dialect.name
+    if dialetto in ("postgresql", "sqlite") and upsert_punteggi:
+        if dialetto == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        for inizio in range(0, len(valori), BLOCCO_UPSERT):
+            stmt = insert(Punteggio).values(valori[inizio:inizio + BLOCCO_UPSERT])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["squadra_id", "gioco_id"], set_={"punti": stmt.excluded.punti}
+            )
+            db.session.execute(stmt)
+    else:
+        # senza indice univoco possono esserci righe ripetute: si aggiornano tutte
+        esistenti = {}
+        for p in Punteggio.query.filter(Punteggio.squadra_id.in_({v["squadra_id"] for v in valori})):
+            esistenti.setdefault((p.squadra_id, p.gioco_id), []).append(p)
+        for v in valori:
+            righe = esistenti.get((v["squadra_id"], v["gioco_id"]))
+            for p in righe or ():
+                p.punti = v["punti"]
+            if not righe:
+                db.session.add(Punteggio(**v))
+    aggiorna_totali(v["squadra_id"] for v in valori)
+
+
+@app.cli.command("rimuovi-punteggi-duplicati")
+@click.option("--dry-run", is_flag=True, help="Elenca i duplicati senza eliminarli.")
+def rimuovi_punteggi_duplicati(dry_run):
+    """Elimina i punteggi ripetuti per la stessa squadra e gioco e crea l'indice univoco.
+
+    Per ogni coppia tiene la riga con l'id più basso: non è detto che sia quella giusta, per
+    questo ogni riga eliminata viene elencata e si può correggere il punteggio a mano.
+    """
+    global upsert_punteggi
+    ripetute = (
+        db.select(Punteggio.squadra_id, Punteggio.gioco_id)
+        .group_by(Punteggio.squadra_id, Punteggio.gioco_id)
+        .having(db.func.count() > 1)
+    )
+    righe = (
+        Punteggio.query.filter(db.tuple_(Punteggio.squadra_id, Punteggio.gioco_id).in_(ripetute))
+        .order_by(Punteggio.squadra_id, Punteggio.gioco_id, Punteggio.id)
+        .all()
+    )
+    eliminate = []
+    for (squadra_id, gioco_id), gruppo in itertools.groupby(righe, key=lambda p: (p.squadra_id, p.gioco_id)):
+        tenuta, *doppie = gruppo
+        click.echo(f"squadra {squadra_id}, gioco {gioco_id}: tengo id {tenuta.id} ({tenuta.punti} punti)")
+        for p in doppie:
+            click.echo(f"  elimino id {p.id} ({p.punti} punti)")
+        eliminate += doppie
+    if dry_run:
+        click.echo(f"Righe da eliminare: {len(eliminate)}")
+        return
+    for p in eliminate:
+        db.session.delete(p)
+    db.session.commit()
+    if eliminate:
+        ricostruisci_classifica()
+    upsert_punteggi = "uq_punteggi_squadra_gioco" not in _aggiorna_schema()
+    click.echo(f"Righe eliminate: {len(eliminate)}")
+
+
+def leggi_punti(valore):
+    """Punteggio da testo ("7", "7,5"); None se vuoto, ValueError se non valido."""
+    if valore is None or str(valore).strip() == "":
+        return None
+    try:
+        punti = float(str(valore).strip().replace(",", "."))
+    except ValueError:
+        raise ValueError("non è un numero") from None
+    if not math.isfinite(punti):
+        raise ValueError("non è un numero")
+    if punti < 0:
+        raise ValueError("non può essere negativo")
+    return punti
+
+
+def _id_valido(valore, esistenti):
+    # in JSON true/false sono int per Python: non devono diventare la squadra 1 o 0
+    return isinstance(valore, int) and not isinstance(valore, bool) and valore in esistenti
+
+
+def valida_griglia(celle, squadre, giochi):
+    """Controlla in un solo passaggio una lista di celle.
+
+    Ogni cella è (squadra_id, gioco_id, punti) oppure (squadra_id, gioco_id, [5 domande]) per il quiz.
+    Restituisce (valori da salvare, {(squadra_id, gioco_id): errore}); le celle vuote sono ignorate.
+    Una cella ripetuta è un errore: lo stesso upsert non può aggiornare due volte la stessa riga.
+    """
+    valori, errori, viste = [], {}, set()
+    for squadra_id, gioco_id, dato in celle:
+        chiave = (squadra_id, gioco_id)
+        if not _id_valido(squadra_id, squadre):
+            errori[chiave] = "squadra inesistente"
+            continue
+        if not _id_valido(gioco_id, giochi):
+            errori[chiave] = "gioco inesistente"
+            continue
+        if chiave in viste:
+            errori[chiave] = "cella ripetuta"
+            continue
+        viste.add(chiave)
+        try:
+            if is_quiz(giochi[gioco_id]):
+                if not isinstance(dato, (list, tuple)) or len(dato) != DOMANDE_QUIZ:
+                    raise ValueError(f"servono {DOMANDE_QUIZ} domande")
+                domande = [leggi_punti(d) for d in dato]
+                punti = None if all(d is None for d in domande) else sum(d or 0.0 for d in domande)
+            else:
+                punti = leggi_punti(dato)
+        except ValueError as e:
+            errori[chiave] = str(e)
+            continue
+        if punti is not None:
+            valori.append({"squadra_id": squadra_id, "gioco_id": gioco_id, "punti": punti})
+    return valori, errori
+
+
+@app.route("/punteggi", methods=["GET", "POST"])
+def punteggi():
+    squadre = Squadra.query.order_by(Squadra.nome.asc()).all()
+    giochi = Gioco.query.order_by(Gioco.id.asc()).all()
+    squadre_per_id = {s.id: s for s in squadre}
+    giochi_per_id = {g.id: g for g in giochi}
+
+    if request.method == "POST" and request.is_json:
+        dati = request.get_json(silent=True)
+        if not isinstance(dati, dict) or not isinstance(dati.get("punteggi"), list):
+            return jsonify({"errore": 'serve un oggetto JSON con la lista "punteggi"'}), 400
+        celle = []
+        for cella in dati["punteggi"]:
+            if not isinstance(cella, dict):
+                return jsonify({"errore": "ogni punteggio deve essere un oggetto"}), 400
+            dato = cella.get("quiz") if "quiz" in cella else cella.get("punti")
+            # liste e oggetti al posto degli id non sono validi (né usabili come chiave dell'errore)
+            squadra_id, gioco_id = (
+                None if isinstance(v, (list, dict)) else v for v in (cella.get("squadra_id"), cella.get("gioco_id"))
+            )
+            celle.append((squadra_id, gioco_id, dato))
+        valori, errori = valida_griglia(celle, squadre_per_id, giochi_per_id)
+        if errori:
+            return jsonify({"errori": [
+                {"squadra_id": s, "gioco_id": g, "errore": e} for (s, g), e in errori.items()
+            ]}), 400
+        salva_punteggi(valori)
+        db.session.commit()
+        return jsonify({"salvati": len(valori)})
+
+    errori = {}
+    if request.method == "POST":
+        celle = []
+        for s in squadre:
+            for g in giochi:
+                if is_quiz(g):
+                    dato = [request.form.get(f"quiz-{s.id}-{g.id}-{i}") for i in range(1, DOMANDE_QUIZ + 1)]
+                else:
+                    dato = request.form.get(f"punti-{s.id}-{g.id}")
+                celle.append((s.id, g.id, dato))
+        valori, errori = valida_griglia(celle, squadre_per_id, giochi_per_id)
+        if not errori:
+            salva_punteggi(valori)
+            db.session.commit()
+            return redirect(url_for("punteggi"))
+
+    attuali = {
+        (p.squadra_id, p.gioco_id): p.punti
+        for p in db.session.query(Punteggio.squadra_id, Punteggio.gioco_id, Punteggio.punti)
+    }
+    return render_template(
+        "punteggi.html",
+        squadre=squadre,
+        giochi=giochi,
+        attuali=attuali,
+        errori=errori,
+        inviato=request.form,
+        domande_quiz=DOMANDE_QUIZ,
+    ), (400 if errori else 200)
+
+# -------------------
+# IMPORTAZIONE / ESPORTAZIONE
+# -------------------
+BLOCCO_IMPORT = 500
+FORMATI_DATA = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y")
+COLONNE_PARTECIPANTI = ("nome", "nascita", "sesso", "luogo", "provincia", "maneggio", "squadra")
+
+
+def leggi_data(valore):
+    for formato in FORMATI_DATA:
         try:
-            punti = float(request.form.get("punti", 0))
+            return datetime.strptime(valore.strip(), formato).date()
         except ValueError:
-            punti = 0.0
+            pass
+    raise ValueError(f"data non valida: {valore!r}")
 
-    # sempre aggiorna/crea con valore valido
-    existing = Punteggio.query.filter_by(squadra_id=squadra.id, gioco_id=gioco.id).first()
-    if existing:
-        existing.punti = punti or 0.0
-    else:
-        db.session.add(Punteggio(squadra_id=squadra.id, gioco_id=gioco.id, punti=punti or 0.0))
+
+def righe_da_file(stream, nome_file):
+    """Itera le righe (dict) di un file CSV, JSON o JSON Lines senza leggerlo tutto, salvo il JSON."""
+    testo = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    estensione = nome_file.rsplit(".", 1)[-1].lower()
+    if estensione in ("jsonl", "ndjson"):
+        return (json.loads(riga) for riga in testo if riga.strip())
+    if estensione == "json":
+        dati = json.load(testo)
+        if isinstance(dati, dict):
+            dati = dati.get("partecipanti", [])
+        if not isinstance(dati, list):
+            raise ValueError('serve una lista di partecipanti o un oggetto con la chiave "partecipanti"')
+        return iter(dati)
+    # CSV: i fogli esportati da Excel in italiano usano spesso il punto e virgola
+    intestazione = testo.readline()
+    delimitatore = max(",;\t", key=intestazione.count)
+    lettore = csv.DictReader(itertools.chain([intestazione], testo), delimiter=delimitatore)
+    lettore.fieldnames = [(c or "").strip().lower() for c in lettore.fieldnames or []]
+    return lettore
+
+
+def _valida_partecipante(riga, squadre):
+    def campo(nome):
+        valore = riga.get(nome)
+        valore = "" if valore is None else str(valore).strip()
+        return valore or None
+
+    for colonna in ("nome", "luogo", "provincia", "maneggio"):
+        lunghezza = Partecipante.__table__.c[colonna].type.length
+        if campo(colonna) and len(campo(colonna)) > lunghezza:
+            raise ValueError(f"{colonna}: massimo {lunghezza} caratteri")
+    nome = campo("nome")
+    if not nome:
+        raise ValueError("nome mancante")
+    if not campo("nascita"):
+        raise ValueError("data di nascita mancante")
+    nascita = leggi_data(campo("nascita"))
+    sesso = (campo("sesso") or "")[:1].upper()
+    if sesso not in ("F", "M", "N"):
+        raise ValueError(f"sesso non valido: {campo('sesso')!r} (F, M o N)")
+    squadra_id = None
+    if campo("squadra"):
+        squadra_id = squadre.get(campo("squadra").lower())
+        if squadra_id is None:
+            raise ValueError(f"squadra sconosciuta: {campo('squadra')!r}")
+    luogo, provincia = campo("luogo"), campo("provincia")
+    return {
+        "nome": nome, "nascita": nascita, "sesso": sesso, "luogo": luogo, "provincia": provincia,
+        "maneggio": campo("maneggio"), "squadra_id": squadra_id,
+        "geo_chiave": chiave_geocodifica(luogo, provincia),
+        "lat": None, "lng": None, "distanza_km": None,
+    }
+
+
+def importa_partecipanti(righe, dry_run=False):
+    """Valida e inserisce i partecipanti a blocchi, in un'unica transazione.
+
+    Se anche una sola riga non è valida non viene salvato nulla. Le coordinate arrivano dalla
+    cache di geocodifica; le località mancanti vengono accodate una volta ciascuna.
+    """
+    squadre = {nome.lower(): id for id, nome in db.session.query(Squadra.id, Squadra.nome)}
+    esito = {"righe": 0, "importati": 0, "errori": [], "da_geocodificare": 0}
+    cache = {}  # geo_chiave → voce Geocodifica valida o None
+    query_geocodifica = {}  # geo_chiave → query per le chiavi da geocodificare
+    blocco = []
+
+    def scrivi_blocco():
+        if not blocco:
+            # file vuoto o righe multiple esatte di BLOCCO_IMPORT: niente da inserire
+            return
+        nuove = {v["geo_chiave"] for v in blocco if v["geo_chiave"] and v["geo_chiave"] not in cache}
+        if nuove:
+            voci = {v.chiave: v for v in Geocodifica.query.filter(Geocodifica.chiave.in_(nuove))}
+            for chiave in nuove:
+                cache[chiave] = voci.get(chiave) if _consulta_cache(voci.get(chiave)) else None
+        for valori in blocco:
+            chiave = valori["geo_chiave"]
+            if chiave is None:
+                continue
+            voce = cache[chiave]
+            if voce is None:
+                query_geocodifica.setdefault(chiave, f"{valori['luogo']}, {valori['provincia']}, Italia")
+            elif voce.trovato:
+                valori["lat"], valori["lng"] = voce.lat, voce.lng
+        coordinate = [(v["lat"], v["lng"]) for v in blocco if v["lat"] is not None]
+        for valori, distanza in zip((v for v in blocco if v["lat"] is not None), distanze_da_base(coordinate)):
+            valori["distanza_km"] = distanza
+        if not dry_run and not esito["errori"]:
+            db.session.execute(db.insert(Partecipante), blocco)
+        esito["importati"] += len(blocco)
+        blocco.clear()
+
+    for numero, riga in enumerate(righe, start=2 if isinstance(righe, csv.DictReader) else 1):
+        esito["righe"] += 1
+        try:
+            if not isinstance(riga, dict):
+                raise ValueError("riga non valida")
+            blocco.append(_valida_partecipante(riga, squadre))
+        except ValueError as e:
+            esito["errori"].append((numero, str(e)))
+            continue
+        if len(blocco) >= BLOCCO_IMPORT:
+            scrivi_blocco()
+    scrivi_blocco()
+
+    esito["da_geocodificare"] = len(query_geocodifica)
+    if dry_run or esito["errori"]:
+        db.session.rollback()
+        if esito["errori"]:
+            esito["importati"] = 0
+        return esito
+    incrementa_versione("partecipanti")
     db.session.commit()
+    for richiesta in query_geocodifica.items():
+        accoda_geocodifica(richiesta)
+    return esito
 
-    return redirect(url_for("dettaglio_squadra", id=squadra.id))
+
+@app.route("/partecipanti/importa", methods=["GET", "POST"])
+def importa():
+    esito = None
+    dry_run = False
+    if request.method == "POST":
+        file = request.files.get("file")
+        dry_run = bool(request.form.get("dry_run"))
+        if not file or not file.filename:
+            esito = {"righe": 0, "importati": 0, "errori": [(0, "nessun file selezionato")], "da_geocodificare": 0}
+        else:
+            try:
+                esito = importa_partecipanti(righe_da_file(file.stream, file.filename), dry_run=dry_run)
+            except (ValueError, UnicodeDecodeError, csv.Error) as e:
+                db.session.rollback()
+                esito = {"righe": 0, "importati": 0, "errori": [(0, f"file non leggibile: {e}")], "da_geocodificare": 0}
+    return render_template(
+        "importa.html", esito=esito, dry_run=dry_run, colonne=COLONNE_PARTECIPANTI
+    ), (400 if esito and esito["errori"] else 200)
+
+
+@app.cli.command("importa-partecipanti")
+@click.argument("file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, help="Valida il file senza salvare nulla.")
+def importa_partecipanti_comando(file, dry_run):
+    """Importa i partecipanti da un file CSV, JSON o JSON Lines."""
+    with open(file, "rb") as f:
+        esito = importa_partecipanti(righe_da_file(f, file), dry_run=dry_run)
+    for numero, errore in esito["errori"]:
+        click.echo(f"riga {numero}: {errore}", err=True)
+    click.echo(
+        f"Righe: {esito['righe']}, {'valide' if dry_run else 'importate'}: {esito['importati']}, "
+        f"località da geocodificare: {esito['da_geocodificare']}"
+    )
+    if esito["errori"]:
+        raise SystemExit(1)
+
+
+def _query_esportazione(tipo):
+    if tipo == "partecipanti":
+        return (
+            db.select(
+                Partecipante.nome, Partecipante.nascita, Partecipante.sesso, Partecipante.luogo,
+                Partecipante.provincia, Partecipante.maneggio, Squadra.nome.label("squadra"),
+                Partecipante.lat, Partecipante.lng, Partecipante.distanza_km,
+            )
+            .outerjoin(Squadra, Partecipante.squadra_id == Squadra.id)
+            .order_by(Partecipante.id)
+        )
+    if tipo == "squadre":
+        return (
+            db.select(Squadra.nome, TotaleSquadra.totale)
+            .outerjoin(TotaleSquadra)
+            .order_by(Squadra.nome)
+        )
+    if tipo == "punteggi":
+        return (
+            db.select(Squadra.nome.label("squadra"), Gioco.nome.label("gioco"), Punteggio.punti)
+            .join(Squadra, Punteggio.squadra_id == Squadra.id)
+            .join(Gioco, Punteggio.gioco_id == Gioco.id)
+            .order_by(Squadra.nome, Gioco.id)
+        )
+    return None
+
+
+def _valore_esportato(valore):
+    return valore.isoformat() if isinstance(valore, date) else valore
+
+
+def stream_json(query):
+    """Array JSON generato a blocchi da una select di colonne."""
+    risultato = db.session.execute(query.execution_options(yield_per=BLOCCO_IMPORT))
+    colonne = list(risultato.keys())
+    yield "["
+    separatore = ""
+    for righe in risultato.partitions():
+        yield separatore + ",".join(
+            json.dumps(dict(zip(colonne, map(_valore_esportato, riga))), ensure_ascii=False)
+            for riga in righe
+        )
+        separatore = ","
+    yield "]"
+
+
+@app.route("/export/<tipo>.<formato>")
+def esporta(tipo, formato):
+    query = _query_esportazione(tipo)
+    if query is None or formato not in ("csv", "json"):
+        return "Esportazione non disponibile", 404
+    query = query.execution_options(yield_per=BLOCCO_IMPORT)
+
+    def genera_csv():
+        buffer = io.StringIO()
+        scrittore = csv.writer(buffer)
+        risultato = db.session.execute(query)
+        scrittore.writerow(risultato.keys())
+        for righe in risultato.partitions():
+            for riga in righe:
+                scrittore.writerow(_valore_esportato(v) for v in riga)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    genera = genera_csv if formato == "csv" else (lambda: stream_json(query))
+    mimetype = "text/csv" if formato == "csv" else "application/json"
+    return Response(
+        stream_with_context(genera()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={tipo}.{formato}"},
+    )
 
 # -------------------
 # AVVIO
@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py legge l'ambiente all'import: database SQLite temporaneo e geocoder finto, mai la rete
+_cartella = tempfile.mkdtemp(prefix="dovesiva-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_cartella, 'test.db')}"
+os.environ["GEOCODER_BACKEND"] = "finto"
+os.environ["GEOCODE_ASYNC"] = "0"
+os.environ["RICHIESTA_LENTA_MS"] = "1e9"
+os.environ.pop("PROFILING", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    with main.app.app_context():
+        main.db.drop_all()
+        main.db.create_all()
+        main._inizializza_contatori()
+    main._cache.clear()
+    main.upsert_punteggi = True
+    yield main.app
+    with main.app.app_context():
+        main.db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def contesto(app):
+    with app.app_context():
+        yield main.db.session
+
+
+@pytest.fixture
+def evento(contesto):
+    """Tre squadre e due giochi (il primo è il quiz), senza punteggi."""
+    squadre = [main.Squadra(nome=nome, totale=main.TotaleSquadra(totale=0)) for nome in ("Aquile", "Lupi", "Volpi")]
+    giochi = [main.Gioco(nome="Quiz"), main.Gioco(nome="Corsa")]
+    contesto.add_all(squadre + giochi)
+    contesto.commit()
+    return {"squadre": [s.id for s in squadre], "giochi": [g.id for g in giochi]}
@@ -0,0 +1,82 @@
+import pytest
+from sqlalchemy import Select, event
+from sqlalchemy.dialects import postgresql
+
+import main
+
+
+def test_totali_dopo_eliminazioni(client, contesto, evento):
+    aquile, lupi, _ = evento["squadre"]
+    quiz, corsa = evento["giochi"]
+    main.salva_punteggi([
+        {"squadra_id": aquile, "gioco_id": corsa, "punti": 4.0},
+        {"squadra_id": aquile, "gioco_id": quiz, "punti": 2.0},
+        {"squadra_id": lupi, "gioco_id": corsa, "punti": 1.0},
+    ])
+    contesto.commit()
+    client.post(f"/giochi/{quiz}/punteggio/{aquile}/delete")
+    assert dict((s.nome, t) for s, t in main.classifica_squadre())["Aquile"] == 4.0
+    client.post(f"/giochi/{corsa}/delete")
+    assert {s.nome: t for s, t in main.classifica_squadre()} == {"Aquile": 0, "Lupi": 0, "Volpi": 0}
+    assert main.Punteggio.query.count() == 0
+
+
+@pytest.fixture
+def istruzioni(contesto):
+    """SQL delle istruzioni eseguite; le SELECT come le compilerebbe PostgreSQL (SQLite omette FOR UPDATE)."""
+    eseguite = []
+
+    def registra(conn, istruzione, *args):
+        dialetto = postgresql.dialect() if isinstance(istruzione, Select) else conn.dialect
+        eseguite.append(str(istruzione.compile(dialect=dialetto)))
+
+    motore = contesto.get_bind()
+    event.listen(motore, "before_execute", registra)
+    yield eseguite
+    event.remove(motore, "before_execute", registra)
+
+
+@pytest.mark.parametrize("azione", ["salva", "elimina"])
+def test_totali_bloccati_prima_di_scrivere(client, contesto, evento, istruzioni, azione):
+    aquile, lupi, _ = evento["squadre"]
+    quiz = evento["giochi"][0]
+    if azione == "salva":
+        main.salva_punteggi([
+            {"squadra_id": lupi, "gioco_id": quiz, "punti": 1.0},
+            {"squadra_id": aquile, "gioco_id": quiz, "punti": 2.0},
+        ])
+    else:
+        main.salva_punteggi([{"squadra_id": aquile, "gioco_id": quiz, "punti": 2.0}])
+        contesto.commit()
+        istruzioni.clear()
+        client.post(f"/giochi/{quiz}/delete")
+    blocco = next(i for i, sql in enumerate(istruzioni) if sql.rstrip().endswith("FOR UPDATE"))
+    assert "ORDER BY team_totals.squadra_id" in istruzioni[blocco]
+    scrittura = next(i for i, sql in enumerate(istruzioni) if sql.startswith(("INSERT INTO punteggi", "DELETE FROM")))
+    assert blocco < scrittura
+    assert any(sql.startswith("UPDATE team_totals") for sql in istruzioni[scrittura:])
+
+
+def test_home_con_etag(client, evento):
+    risposta = client.get("/")
+    assert risposta.status_code == 200
+    etag = risposta.headers["ETag"]
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 304
+    client.post(f"/squadre/{evento['squadre'][0]}/punteggio/{evento['giochi'][1]}", data={"punti": "3"})
+    risposta = client.get("/", headers={"If-None-Match": etag})
+    assert risposta.status_code == 200
+    assert risposta.headers["ETag"] != etag
+
+
+def test_in_cache_ricalcola_solo_al_cambio_di_versione(contesto):
+    calcoli = []
+
+    def calcola():
+        calcoli.append(1)
+        return len(calcoli)
+
+    assert main.in_cache("prova", ("classifica",), calcola) == 1
+    assert main.in_cache("prova", ("classifica",), calcola) == 1
+    main.incrementa_versione("classifica")
+    contesto.commit()
+    assert main.in_cache("prova", ("classifica",), calcola) == 2
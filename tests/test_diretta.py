@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+import main
+
+
+def test_delta_classifica():
+    prima = {1: {"nome": "Aquile", "totale": 3.0}, 2: {"nome": "Lupi", "totale": 1.0}, 3: {"nome": "Volpi", "totale": 0}}
+    dopo = {1: {"nome": "Aquile", "totale": 5.0}, 2: {"nome": "Lupi", "totale": 1.0}, 4: {"nome": "Orsi", "totale": 0}}
+    assert main.delta_classifica(prima, dopo) == {
+        "aggiornate": {1: {"nome": "Aquile", "totale": 5.0}, 4: {"nome": "Orsi", "totale": 0}},
+        "rimosse": [3],
+    }
+    assert main.delta_classifica(dopo, dopo) == {"aggiornate": {}, "rimosse": []}
+
+
+def test_api_classifica(client, evento):
+    risposta = client.get("/api/classifica")
+    assert risposta.status_code == 200
+    assert {s["nome"] for s in risposta.json["squadre"].values()} == {"Aquile", "Lupi", "Volpi"}
+    assert client.get("/api/classifica", headers={"If-None-Match": risposta.headers["ETag"]}).status_code == 304
+
+
+@pytest.fixture
+def notifiche(app, monkeypatch):
+    # un osservatore nuovo per ogni test: il database viene ricreato e le versioni ripartono da capo
+    monkeypatch.setitem(app.config, "SSE_POLLING", 0.02)
+    monkeypatch.setitem(app.config, "SSE_KEEPALIVE", 1)
+    osservatore = main.NotificheClassifica()
+    monkeypatch.setattr(main, "notifiche_classifica", osservatore)
+    return osservatore
+
+
+def prossimo_evento(stream):
+    for blocco in stream:
+        testo = blocco.decode()
+        if testo.startswith("event:"):
+            righe = dict(riga.split(": ", 1) for riga in testo.strip().splitlines())
+            return righe["event"], json.loads(righe["data"])
+    raise AssertionError("stream chiuso")
+
+
+def test_stream_classifica_invia_solo_le_differenze(client, evento, notifiche):
+    aquile, lupi, _ = evento["squadre"]
+    corsa = evento["giochi"][1]
+    risposta = client.get("/stream/classifica", buffered=False)
+    assert risposta.mimetype == "text/event-stream"
+    stream = iter(risposta.response)
+
+    tipo, dati = prossimo_evento(stream)
+    assert tipo == "classifica"
+    assert {s["nome"]: s["totale"] for s in dati["squadre"].values()} == {"Aquile": 0, "Lupi": 0, "Volpi": 0}
+
+    client.post(f"/squadre/{aquile}/punteggio/{corsa}", data={"punti": "4"})
+    tipo, delta = prossimo_evento(stream)
+    assert tipo == "delta"
+    assert delta["aggiornate"] == {str(aquile): {"nome": "Aquile", "totale": 4.0}}
+    assert delta["rimosse"] == []
+    assert delta["versione"] > dati["versione"]
+
+    client.post(f"/squadre/{lupi}/delete")
+    tipo, delta = prossimo_evento(stream)
+    assert (tipo, delta["aggiornate"], delta["rimosse"]) == ("delta", {}, [lupi])
+    risposta.close()
+    assert notifiche.client() == 0
+
+
+def test_stream_oltre_il_limite_risponde_503(app, client, evento, notifiche, monkeypatch):
+    monkeypatch.setitem(app.config, "SSE_MAX_CLIENT", 1)
+    primo = client.get("/stream/classifica", buffered=False)
+    assert primo.status_code == 200
+    secondo = client.get("/stream/classifica")
+    assert secondo.status_code == 503
+    assert secondo.headers["Retry-After"]
+    primo.close()
+    terzo = client.get("/stream/classifica", buffered=False)
+    assert terzo.status_code == 200
+    terzo.close()
+
+
+def test_home_link_alla_modalita_live(client, evento):
+    assert "/?live=1" in client.get("/").text
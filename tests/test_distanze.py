@@ -0,0 +1,40 @@
+from datetime import date
+
+import pytest
+
+import main
+
+
+def partecipante(nome, lat, lng):
+    return main.Partecipante(
+        nome=nome, nascita=date(2010, 1, 1), sesso="F", luogo="Luogo", provincia="BO",
+        lat=lat, lng=lng, distanza_km=main.distanza_da_base(lat, lng),
+    )
+
+
+def test_distanze_da_base():
+    assert main.distanza_da_base(*main.app.config["BASE_COORDS"]) == 0
+    assert main.distanza_da_base(None, 11.0) is None
+    # Bologna → Milano: circa 200 km in linea d'aria
+    assert 195 < main.distanze_da_base([(45.4642, 9.19)])[0] < 205
+
+
+def test_ricalcola_distanze_dopo_cambio_base(app, contesto, monkeypatch):
+    contesto.add_all([partecipante("Milano", 45.4642, 9.19), partecipante("Senza", None, None)])
+    contesto.commit()
+    monkeypatch.setitem(app.config, "BASE_COORDS", (45.4642, 9.19))
+    assert app.test_cli_runner().invoke(args=["ricalcola-distanze"]).exit_code == 0
+    contesto.expire_all()
+    distanze = dict(contesto.query(main.Partecipante.nome, main.Partecipante.distanza_km))
+    assert distanze["Milano"] == pytest.approx(0, abs=1e-6)
+    assert distanze["Senza"] is None
+
+
+def test_partecipanti_piu_lontani(contesto):
+    contesto.add_all([
+        partecipante("Milano", 45.4642, 9.19), partecipante("Roma", 41.9028, 12.4964),
+        partecipante("Modena", 44.6471, 10.9252), partecipante("Senza", None, None),
+    ])
+    contesto.commit()
+    assert [p.nome for p in main.partecipanti_piu_lontani(2)] == ["Roma", "Milano"]
+    assert len(main.partecipanti_piu_lontani(10)) == 3
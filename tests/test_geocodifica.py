@@ -0,0 +1,90 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+class GeocoderContato(main.GeocoderFinto):
+    """Geocoder finto che registra le chiamate; "Nessuno" non viene trovato."""
+
+    def __init__(self, intervallo=0.0):
+        self.intervallo = intervallo
+        self.chiamate = []
+
+    def geocode(self, query):
+        self.chiamate.append((time.monotonic(), query))
+        return None if query.startswith("Nessuno") else super().geocode(query)
+
+
+@pytest.fixture
+def geocoder(app, monkeypatch):
+    finto = GeocoderContato()
+    monkeypatch.setitem(app.config, "GEOCODER", finto)
+    return finto
+
+
+def nuovo_partecipante(client, nome, luogo, provincia="BO"):
+    client.post("/partecipanti", data={
+        "nome": nome, "nascita": "2010-01-01", "sesso": "F", "luogo": luogo, "provincia": provincia,
+    })
+    return main.Partecipante.query.filter_by(nome=nome).one()
+
+
+def test_chiave_geocodifica():
+    assert main.chiave_geocodifica("  Sasso  Marconi ", "Bo") == "sasso marconi|bo"
+    assert main.chiave_geocodifica("Forlì", "FC") == main.chiave_geocodifica("forli'", "fc")
+    assert main.chiave_geocodifica("", "BO") is None
+    assert main.chiave_geocodifica("Bologna", None) is None
+
+
+def test_cache_una_chiamata_per_localita(client, contesto, geocoder):
+    primo = nuovo_partecipante(client, "Anna", "Sasso Marconi")
+    secondo = nuovo_partecipante(client, "Bruno", "sasso  marconi", "bo")
+    assert len(geocoder.chiamate) == 1
+    assert (primo.lat, primo.lng) == (secondo.lat, secondo.lng)
+    assert secondo.distanza_km == pytest.approx(main.distanza_da_base(primo.lat, primo.lng))
+
+
+def test_esito_negativo_in_cache_fino_alla_scadenza(client, contesto, geocoder):
+    assert nuovo_partecipante(client, "Anna", "Nessuno").lat is None
+    nuovo_partecipante(client, "Bruno", "Nessuno")
+    assert len(geocoder.chiamate) == 1
+
+    voce = contesto.get(main.Geocodifica, "nessuno|bo")
+    voce.aggiornato = datetime.utcnow() - timedelta(hours=main.app.config["GEOCODE_TTL_NEGATIVO_ORE"] + 1)
+    contesto.commit()
+    assert main.localita_da_geocodificare() == [("nessuno|bo", "Nessuno, BO, Italia")]
+    nuovo_partecipante(client, "Carla", "Nessuno")
+    assert len(geocoder.chiamate) == 2
+
+
+def test_localita_in_sospeso_riprese_dal_database(app, contesto, geocoder):
+    # salvati da un worker che si è fermato prima di geocodificarli
+    contesto.add_all(
+        main.Partecipante(
+            nome=f"P{i}", nascita=datetime(2010, 1, 1).date(), sesso="F", luogo=f"Luogo {i % 2}",
+            provincia="MO", geo_chiave=main.chiave_geocodifica(f"Luogo {i % 2}", "MO"),
+        )
+        for i in range(4)
+    )
+    contesto.commit()
+    assert sorted(main.localita_da_geocodificare()) == [
+        ("luogo 0|mo", "Luogo 0, MO, Italia"), ("luogo 1|mo", "Luogo 1, MO, Italia"),
+    ]
+    esito = app.test_cli_runner().invoke(args=["geocodifica-mancanti"])
+    assert "geocodificate: 2" in esito.output
+    assert len(geocoder.chiamate) == 2
+    assert main.Partecipante.query.filter(main.Partecipante.distanza_km.is_(None)).count() == 0
+    assert main.localita_da_geocodificare() == []
+
+
+def test_turno_del_geocoder_condiviso(contesto, geocoder):
+    geocoder.intervallo = 0.2
+    for i in range(3):
+        main.geocodifica(f"luogo {i}|bo", f"Luogo {i}, BO, Italia")
+    istanti = [istante for istante, _ in geocoder.chiamate]
+    assert all(b - a >= 0.18 for a, b in zip(istanti, istanti[1:]))
+    assert contesto.get(main.Contatore, "geocoder", populate_existing=True).valore == 3
+
@@ -0,0 +1,101 @@
+import io
+import json
+from datetime import date
+
+import pytest
+
+import main
+
+
+def importa(client, contenuto, nome_file, dry_run=False):
+    dati = {"file": (io.BytesIO(contenuto.encode() if isinstance(contenuto, str) else contenuto), nome_file)}
+    if dry_run:
+        dati["dry_run"] = "1"
+    return client.post("/partecipanti/importa", data=dati, content_type="multipart/form-data")
+
+
+def test_csv_con_punto_e_virgola(client, contesto, evento):
+    csv = (
+        "Nome;Nascita;Sesso;Luogo;Provincia;Maneggio;Squadra\n"
+        "Anna;03/04/2012;f;Sasso Marconi;BO;Stella;aquile\n"
+        "Bruno;2011-12-01;M;;;;\n"
+    )
+    risposta = importa(client, csv, "iscritti.csv")
+    assert risposta.status_code == 200
+    anna, bruno = main.Partecipante.query.order_by(main.Partecipante.nome).all()
+    assert (anna.nascita, anna.sesso, anna.squadra.nome) == (date(2012, 4, 3), "F", "Aquile")
+    assert anna.geo_chiave == "sasso marconi|bo"
+    assert anna.lat is not None and anna.distanza_km is not None  # geocoder finto, in modo sincrono
+    assert (bruno.squadra_id, bruno.geo_chiave, bruno.lat) == (None, None, None)
+
+
+def test_dry_run_non_salva(client, contesto, evento):
+    risposta = importa(client, "nome,nascita,sesso\nAnna,2012-04-03,F\n", "a.csv", dry_run=True)
+    assert risposta.status_code == 200
+    assert main.Partecipante.query.count() == 0
+
+
+def test_una_riga_non_valida_annulla_tutto(contesto, evento):
+    righe = [{"nome": f"P{i}", "nascita": "2010-01-01", "sesso": "F"} for i in range(main.BLOCCO_IMPORT + 10)]
+    righe[-1]["sesso"] = "X"
+    esito = main.importa_partecipanti(iter(righe))
+    assert esito["importati"] == 0
+    assert esito["errori"] == [(len(righe), "sesso non valido: 'X' (F, M o N)")]
+    assert main.Partecipante.query.count() == 0
+
+
+@pytest.mark.parametrize("n_righe", [main.BLOCCO_IMPORT, 2 * main.BLOCCO_IMPORT])
+def test_righe_multiple_del_blocco(client, contesto, evento, n_righe):
+    csv = "nome,nascita,sesso\n" + "".join(f"P{i},2010-01-01,F\n" for i in range(n_righe))
+    assert importa(client, csv, "iscritti.csv").status_code == 200
+    assert main.Partecipante.query.count() == n_righe
+
+
+@pytest.mark.parametrize("contenuto", ["", "nome,nascita,sesso\n"])
+def test_file_senza_righe(client, contesto, evento, contenuto):
+    assert importa(client, contenuto, "vuoto.csv").status_code == 200
+    assert main.Partecipante.query.count() == 0
+
+
+@pytest.mark.parametrize("riga, errore", [
+    ({"nascita": "2010-01-01", "sesso": "F"}, "nome mancante"),
+    ({"nome": "A", "sesso": "F"}, "data di nascita mancante"),
+    ({"nome": "A", "nascita": "31/02/2010", "sesso": "F"}, "data non valida: '31/02/2010'"),
+    ({"nome": "A", "nascita": "2010-01-01", "sesso": "F", "squadra": "Orsi"}, "squadra sconosciuta: 'Orsi'"),
+    ({"nome": "A" * 101, "nascita": "2010-01-01", "sesso": "F"}, "nome: massimo 100 caratteri"),
+    ({"nome": "A", "nascita": "2010-01-01", "sesso": "F", "provincia": "P" * 51}, "provincia: massimo 50 caratteri"),
+    (5, "riga non valida"),
+])
+def test_errori_per_riga(contesto, evento, riga, errore):
+    esito = main.importa_partecipanti(iter([riga]))
+    assert esito["errori"] == [(1, errore)]
+
+
+def test_json_e_jsonl(client, contesto, evento):
+    persona = {"nome": "Anna", "nascita": "2012-04-03", "sesso": "F", "squadra": "Lupi"}
+    assert importa(client, json.dumps({"partecipanti": [persona]}), "a.json").status_code == 200
+    assert importa(client, json.dumps([persona]), "a.json").status_code == 200
+    assert importa(client, json.dumps(persona) + "\n\n" + json.dumps(persona) + "\n", "a.jsonl").status_code == 200
+    assert main.Partecipante.query.count() == 4
+
+
+@pytest.mark.parametrize("contenuto, nome_file", [
+    ("5", "a.json"),
+    ('"testo"', "a.json"),
+    ('{"partecipanti": 5}', "a.json"),
+    ("[", "a.json"),
+    ('{"nome": "A"\n', "a.jsonl"),
+    (b"\xff\xfe\x00", "a.csv"),
+])
+def test_file_non_leggibile(client, contesto, evento, contenuto, nome_file):
+    risposta = importa(client, contenuto, nome_file)
+    assert risposta.status_code == 400
+    assert "file non leggibile" in risposta.text
+    assert main.Partecipante.query.count() == 0
+
+
+def test_esportazione_json(client, contesto, evento):
+    importa(client, "nome,nascita,sesso,squadra\nAnna,2012-04-03,F,Volpi\n", "a.csv")
+    dati = client.get("/export/partecipanti.json").json
+    assert [(p["nome"], p["nascita"], p["squadra"]) for p in dati] == [("Anna", "2012-04-03", "Volpi")]
+    assert client.get("/export/nulla.json").status_code == 404
@@ -0,0 +1,51 @@
+import re
+
+import main
+
+
+def valore(client, nome, etichette):
+    # i contatori sono per processo: si confrontano prima e dopo
+    trovato = re.search(rf"{nome}\{{{re.escape(etichette)}\}} ([\d.]+)", client.get("/metrics").text)
+    return float(trovato.group(1)) if trovato else 0
+
+
+def test_server_timing_e_query_contate(client, evento):
+    prima = valore(client, "dovesiva_sql_query_totale", 'endpoint="squadre"')
+    risposta = client.get("/squadre")
+    assert re.fullmatch(r'app;dur=[\d.]+, sql;dur=[\d.]+;desc="\d+ query"', risposta.headers["Server-Timing"])
+    n_query = int(re.search(r'"(\d+) query"', risposta.headers["Server-Timing"]).group(1))
+    assert n_query > 0
+    assert valore(client, "dovesiva_sql_query_totale", 'endpoint="squadre"') == prima + n_query
+
+
+def test_metrics(app, client, contesto, monkeypatch):
+    monkeypatch.setitem(app.config, "GEOCODER", main.GeocoderFinto())
+    prima = valore(client, "dovesiva_geocoder_chiamate_totale", 'esito="trovato"')
+    client.post("/partecipanti", data={
+        "nome": "Anna", "nascita": "2010-01-01", "sesso": "F", "luogo": "Sasso Marconi", "provincia": "BO",
+    })
+    assert valore(client, "dovesiva_geocoder_chiamate_totale", 'esito="trovato"') == prima + 1
+    testo = client.get("/metrics").text
+    assert "dovesiva_coda_geocodifica 0" in testo
+    assert "dovesiva_client_sse" in testo
+
+
+def test_una_sola_richiesta_profilata_per_volta(app, client, evento, monkeypatch, caplog):
+    monkeypatch.setitem(app.config, "PROFILING", "header")
+    client.get("/squadre", headers={"X-Profile": "1"})
+    assert "Profilo di GET /squadre" in caplog.text
+    assert not main._profilazione.locked()
+
+    caplog.clear()
+    with main._profilazione:  # un'altra richiesta in profilazione
+        assert client.get("/squadre", headers={"X-Profile": "1"}).status_code == 200
+    assert "Profilo di" not in caplog.text
+
+
+def test_profilo_fermato_anche_dopo_un_errore(app, monkeypatch):
+    monkeypatch.setitem(app.config, "PROFILING", "tutte")
+    with app.test_request_context("/squadre"):
+        app.preprocess_request()
+        assert main._profilazione.locked()
+        app.do_teardown_request(RuntimeError("errore nella vista"))
+    assert not main._profilazione.locked()
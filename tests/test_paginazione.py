@@ -0,0 +1,116 @@
+import base64
+import json
+import re
+from datetime import date
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def partecipanti(contesto):
+    contesto.execute(main.db.insert(main.Partecipante), [
+        {
+            "nome": f"Cavaliere {i % 7}",  # nomi ripetuti: l'ordine dipende anche dall'id
+            "nascita": date(2010, 1, 1),
+            "sesso": "F",
+            "maneggio": "Maneggio Stella" if i % 3 else "Maneggio Sole",
+            "provincia": "BO" if i % 2 else "MO",
+        }
+        for i in range(23)
+    ])
+    contesto.commit()
+    return [(p.nome, p.id) for p in main.Partecipante.query.order_by(main.Partecipante.nome, main.Partecipante.id)]
+
+
+def cursore(valori):
+    return base64.urlsafe_b64encode(json.dumps(valori).encode()).decode()
+
+
+def pagina(app, url):
+    with app.test_request_context(url):
+        query = main._filtri_partecipanti(main.Partecipante.query)
+        righe, prima, dopo = main.pagina_keyset(query, (main.Partecipante.nome, main.Partecipante.id))
+        return [(p.nome, p.id) for p in righe], prima, dopo
+
+
+def test_avanti_e_indietro_percorrono_tutte_le_righe(app, partecipanti):
+    visti, pagine, dopo = [], [], None
+    while True:
+        righe, prima, dopo = pagina(app, "/?per=5" + (f"&dopo={dopo}" if dopo else ""))
+        assert (prima is None) == (not pagine)
+        visti += righe
+        pagine.append(righe)
+        if dopo is None:
+            break
+    assert visti == partecipanti
+    assert [len(p) for p in pagine] == [5, 5, 5, 5, 3]
+
+    # dall'ultima pagina all'indietro si ritrovano le stesse pagine
+    indietro = cursore(list(pagine[-1][0]))
+    for attesa in reversed(pagine[:-1]):
+        righe, prima, dopo = pagina(app, f"/?per=5&prima={indietro}")
+        assert righe == attesa
+        assert dopo is not None
+        indietro = prima
+    assert indietro is None
+
+
+def test_cursore_non_valido_riparte_dalla_prima_pagina(app, client, partecipanti):
+    non_validi = (
+        "???", cursore({"a": 1}), cursore([{"a": 1}, 2]), cursore([True, 1]), cursore(["x"]),
+        cursore([1, 2]), cursore(["Cavaliere 1", "3"]), cursore(["Cavaliere 1", 3.5]),
+    )
+    for testo in non_validi:
+        for direzione in ("dopo", "prima"):
+            righe, prima, _ = pagina(app, f"/?per=5&{direzione}={testo}")
+            assert righe == partecipanti[:5]
+            assert prima is None
+            assert client.get(f"/partecipanti?{direzione}={testo}").status_code == 200
+
+
+def test_cursore_con_tipi_delle_colonne(app, contesto, evento):
+    with app.test_request_context(f"/?per=1&dopo={cursore(['x'])}"):
+        righe, _, dopo = main.pagina_keyset(main.Gioco.query, (main.Gioco.id,))
+    assert [g.id for g in righe] == evento["giochi"][:1]
+    with app.test_request_context(f"/?per=1&dopo={dopo}"):
+        righe, _, _ = main.pagina_keyset(main.Gioco.query, (main.Gioco.id,))
+    assert [g.id for g in righe] == evento["giochi"][1:]
+    assert main._decodifica_cursore(cursore([1, 2]), (main.Partecipante.nome, main.Partecipante.id)) is None
+    assert main._decodifica_cursore(cursore(["A", 2]), (main.Partecipante.nome, main.Partecipante.id)) == ["A", 2]
+
+
+def test_filtri_senza_maiuscole(app, client, partecipanti, contesto):
+    righe, _, _ = pagina(app, "/?per=200&maneggio=maneggio%20SOLE&provincia=mo")
+    attese = [
+        (p.nome, p.id)
+        for p in main.Partecipante.query.filter_by(maneggio="Maneggio Sole", provincia="MO")
+        .order_by(main.Partecipante.nome, main.Partecipante.id)
+    ]
+    assert righe == attese and attese
+
+    dati = client.get("/api/partecipanti?maneggio=maneggio%20sole&provincia=MO").json
+    assert [(p["nome"], p["id"]) for p in dati] == attese
+
+
+@pytest.mark.parametrize("url, indice", [
+    ("/?per=5", "ix_partecipanti_nome_id"),
+    ("/?per=5&maneggio=stella", "ix_partecipanti_lower_maneggio_nome"),
+    ("/?per=5&provincia=bo", "ix_partecipanti_lower_provincia_nome"),
+])
+def test_pagine_usano_un_indice(app, contesto, url, indice):
+    with app.test_request_context(url):
+        query = main._filtri_partecipanti(main.Partecipante.query)
+        query = query.order_by(main.Partecipante.nome, main.Partecipante.id).limit(6)
+        sql = query.statement.compile(main.db.engine, compile_kwargs={"literal_binds": True})
+        piano = " ".join(r[-1] for r in contesto.execute(main.db.text(f"EXPLAIN QUERY PLAN {sql}")))
+    assert indice in piano
+    assert "TEMP B-TREE" not in piano
+
+
+def test_pagina_partecipanti_html(client, partecipanti):
+    risposta = client.get("/partecipanti?per=5")
+    assert risposta.status_code == 200
+    dopo = re.search(r"dopo=([\w=-]+)", risposta.text).group(1)
+    assert client.get(f"/partecipanti?per=5&dopo={dopo}").status_code == 200
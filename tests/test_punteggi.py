@@ -0,0 +1,141 @@
+import main
+
+
+def punteggi(contesto):
+    return {(p.squadra_id, p.gioco_id): p.punti for p in main.Punteggio.query}
+
+
+def test_salva_punteggi_inserisce_e_poi_aggiorna(contesto, evento):
+    aquile, lupi, _ = evento["squadre"]
+    _, corsa = evento["giochi"]
+    main.salva_punteggi([{"squadra_id": aquile, "gioco_id": corsa, "punti": 4.0}])
+    contesto.commit()
+    main.salva_punteggi([
+        {"squadra_id": aquile, "gioco_id": corsa, "punti": 6.5},
+        {"squadra_id": lupi, "gioco_id": corsa, "punti": 2.0},
+    ])
+    contesto.commit()
+    assert punteggi(contesto) == {(aquile, corsa): 6.5, (lupi, corsa): 2.0}
+    assert main.Punteggio.query.count() == 2
+    totali = {s.id: totale for s, totale in main.classifica_squadre()}
+    assert totali[aquile] == 6.5 and totali[lupi] == 2.0
+
+
+def test_salva_punteggi_senza_indice_univoco_aggiorna_tutte_le_righe(contesto, evento, monkeypatch):
+    aquile = evento["squadre"][0]
+    corsa = evento["giochi"][1]
+    contesto.execute(main.db.text("DROP INDEX uq_punteggi_squadra_gioco"))
+    contesto.add_all([main.Punteggio(squadra_id=aquile, gioco_id=corsa, punti=p) for p in (1, 2)])
+    contesto.commit()
+    monkeypatch.setattr(main, "upsert_punteggi", False)
+    main.salva_punteggi([{"squadra_id": aquile, "gioco_id": corsa, "punti": 9.0}])
+    contesto.commit()
+    assert [p.punti for p in main.Punteggio.query] == [9.0, 9.0]
+
+
+def test_rimuovi_punteggi_duplicati(app, contesto, evento):
+    aquile = evento["squadre"][0]
+    corsa = evento["giochi"][1]
+    contesto.execute(main.db.text("DROP INDEX uq_punteggi_squadra_gioco"))
+    contesto.add_all([main.Punteggio(squadra_id=aquile, gioco_id=corsa, punti=p) for p in (3, 4)])
+    contesto.commit()
+
+    esito = app.test_cli_runner().invoke(args=["rimuovi-punteggi-duplicati", "--dry-run"])
+    assert "elimino id 2 (4.0 punti)" in esito.output
+    assert main.Punteggio.query.count() == 2
+
+    esito = app.test_cli_runner().invoke(args=["rimuovi-punteggi-duplicati"])
+    assert "Righe eliminate: 1" in esito.output
+    assert punteggi(contesto) == {(aquile, corsa): 3.0}
+    assert main.upsert_punteggi
+    indici = {i["name"] for i in main.db.inspect(main.db.engine).get_indexes("punteggi")}
+    assert "uq_punteggi_squadra_gioco" in indici
+
+
+def test_leggi_punti():
+    assert main.leggi_punti("7,5") == 7.5
+    assert main.leggi_punti("  ") is None
+    for valore in ("abc", "nan", "inf", "-1", True):
+        try:
+            main.leggi_punti(valore)
+        except ValueError:
+            continue
+        raise AssertionError(f"{valore!r} accettato")
+
+
+def test_griglia_json(client, contesto, evento):
+    aquile, lupi, volpi = evento["squadre"]
+    quiz, corsa = evento["giochi"]
+    risposta = client.post("/punteggi", json={"punteggi": [
+        {"squadra_id": aquile, "gioco_id": quiz, "quiz": [1, 2, "", None, "0,5"]},
+        {"squadra_id": lupi, "gioco_id": corsa, "punti": "7"},
+        {"squadra_id": volpi, "gioco_id": corsa, "punti": ""},
+    ]})
+    assert risposta.status_code == 200
+    assert risposta.json == {"salvati": 2}
+    assert punteggi(contesto) == {(aquile, quiz): 3.5, (lupi, corsa): 7.0}
+
+
+def test_griglia_json_errori_per_cella_senza_salvare(client, contesto, evento):
+    aquile, lupi, _ = evento["squadre"]
+    quiz, corsa = evento["giochi"]
+    risposta = client.post("/punteggi", json={"punteggi": [
+        {"squadra_id": aquile, "gioco_id": corsa, "punti": 1},
+        {"squadra_id": aquile, "gioco_id": corsa, "punti": 2},
+        {"squadra_id": True, "gioco_id": corsa, "punti": 1},
+        {"squadra_id": [lupi], "gioco_id": corsa, "punti": 1},
+        {"squadra_id": lupi, "gioco_id": 999, "punti": 1},
+        {"squadra_id": lupi, "gioco_id": corsa, "punti": "abc"},
+        {"squadra_id": lupi, "gioco_id": quiz, "quiz": [1, 2]},
+    ]})
+    assert risposta.status_code == 400
+    errori = {(e["squadra_id"], e["gioco_id"]): e["errore"] for e in risposta.json["errori"]}
+    assert errori == {
+        (aquile, corsa): "cella ripetuta",
+        (True, corsa): "squadra inesistente",
+        (None, corsa): "squadra inesistente",
+        (lupi, 999): "gioco inesistente",
+        (lupi, corsa): "non è un numero",
+        (lupi, quiz): "servono 5 domande",
+    }
+    assert punteggi(contesto) == {}
+
+
+def test_griglia_json_corpo_non_valido(client, evento):
+    for corpo in ([1, 2], {"punteggi": 5}, {}, "testo"):
+        assert client.post("/punteggi", json=corpo).status_code == 400
+    assert client.post("/punteggi", data="{", content_type="application/json").status_code == 400
+    assert client.post("/punteggi", json={"punteggi": [5]}).status_code == 400
+
+
+def test_griglia_get_json_non_scrive(client, contesto, evento):
+    aquile = evento["squadre"][0]
+    corsa = evento["giochi"][1]
+    corpo = {"punteggi": [{"squadra_id": aquile, "gioco_id": corsa, "punti": 1}]}
+    assert client.get("/punteggi", json=corpo).status_code == 200
+    assert punteggi(contesto) == {}
+
+
+def test_griglia_form(client, contesto, evento):
+    aquile, lupi, _ = evento["squadre"]
+    quiz, corsa = evento["giochi"]
+    risposta = client.post("/punteggi", data={f"punti-{aquile}-{corsa}": "abc", f"punti-{lupi}-{corsa}": "3"})
+    assert risposta.status_code == 400
+    assert punteggi(contesto) == {}
+    risposta = client.post("/punteggi", data={f"punti-{lupi}-{corsa}": "3", f"quiz-{lupi}-{quiz}-2": "1"})
+    assert risposta.status_code == 302
+    assert punteggi(contesto) == {(lupi, corsa): 3.0, (lupi, quiz): 1.0}
+
+
+def test_salva_punteggio_non_sovrascrive_con_zero(client, contesto, evento):
+    aquile = evento["squadre"][0]
+    quiz, corsa = evento["giochi"]
+    assert client.post(f"/squadre/{aquile}/punteggio/{corsa}", data={"punti": "5"}).status_code == 302
+    for dati in ({"punti": "abc"}, {"punti": ""}, {"punti": "-2"}, {}):
+        risposta = client.post(f"/squadre/{aquile}/punteggio/{corsa}", data=dati)
+        assert risposta.status_code == 400
+        assert "Punteggio non salvato" in risposta.text
+    assert punteggi(contesto) == {(aquile, corsa): 5.0}
+
+    assert client.post(f"/squadre/{aquile}/punteggio/{quiz}", data={"quiz_1": "2", "quiz_4": "1,5"}).status_code == 302
+    assert punteggi(contesto)[(aquile, quiz)] == 3.5
@@ -0,0 +1,45 @@
+from datetime import date
+
+import main
+
+
+def partecipante(nome, nascita, sesso, maneggio, provincia="BO", distanza_km=None):
+    return main.Partecipante(
+        nome=nome, nascita=date.fromisoformat(nascita), sesso=sesso, maneggio=maneggio,
+        luogo="Luogo", provincia=provincia, distanza_km=distanza_km,
+    )
+
+
+def test_statistiche_in_una_passata(contesto):
+    contesto.add_all([
+        partecipante("Anna", "2012-05-01", "F", "Il Cavallino", distanza_km=10.0),
+        partecipante("Bea", "2014-03-02", "F", "Il Cavallino", distanza_km=40.0),
+        partecipante("Carlo", "2009-01-10", "M", "Le Querce", "MO", distanza_km=25.0),
+        partecipante("Dario", "2013-07-07", "M", None, "MO"),
+    ])
+    contesto.commit()
+    stats = main.statistiche_partecipanti()
+    assert stats.totale == 4
+    assert (stats.piu_giovane_f.nome, stats.piu_giovane_m.nome) == ("Bea", "Dario")
+    assert stats.piu_vecchio.nome == "Carlo"
+    assert stats.piu_lontano.nome == "Bea"
+    assert stats.maneggi == [("Il Cavallino", 2, 40.0), (None, 1, None), ("Le Querce", 1, 25.0)]
+    assert (stats.maneggio_top, stats.maneggio_lontano, stats.distanza_lontano) == ("Il Cavallino", "Il Cavallino", 40.0)
+    assert [p[:2] for p in stats.province] == [("BO", 2), ("MO", 2)]
+
+
+def test_statistiche_senza_partecipanti(client, contesto):
+    stats = main.statistiche_partecipanti()
+    assert (stats.totale, stats.piu_vecchio, stats.maneggio_top) == (0, None, None)
+    assert client.get("/statistiche").status_code == 200
+
+
+def test_statistiche_ricalcolate_dopo_un_nuovo_partecipante(client, contesto):
+    assert client.get("/api/statistiche").json["totale"] == 0
+    client.post("/partecipanti", data={
+        "nome": "Anna", "nascita": "2010-01-01", "sesso": "F", "luogo": "Bologna", "provincia": "BO",
+    })
+    dati = client.get("/api/statistiche").json
+    assert dati["totale"] == 1
+    assert dati["piu_giovane"]["F"]["nome"] == "Anna"
+    assert [p["nome"] for p in dati["piu_lontani"]] == ["Anna"]
@@ -0,0 +1,55 @@
+import main
+
+
+def test_posizioni_a_pari_merito():
+    assert main._posizioni([10, 10, 8, 7, 7, 7, 1]) == [1, 1, 3, 4, 4, 4, 7]
+    assert main._posizioni([]) == []
+
+
+def test_tabellone_pari_merito(client, contesto, evento):
+    aquile, lupi, volpi = evento["squadre"]
+    quiz, corsa = evento["giochi"]
+    main.salva_punteggi([
+        {"squadra_id": aquile, "gioco_id": corsa, "punti": 5.0},
+        {"squadra_id": lupi, "gioco_id": corsa, "punti": 5.0},
+        {"squadra_id": volpi, "gioco_id": corsa, "punti": 2.0},
+        {"squadra_id": volpi, "gioco_id": quiz, "punti": 3.0},
+    ])
+    contesto.commit()
+    dati = client.get("/tabellone.json").json
+    righe = {r["nome"]: r for r in dati["squadre"]}
+    assert [g["nome"] for g in dati["giochi"]] == ["Quiz", "Corsa"]
+    assert righe["Aquile"]["celle"][str(corsa)] == {"punti": 5.0, "posizione": 1, "pari_merito": True}
+    assert righe["Lupi"]["celle"][str(corsa)] == {"punti": 5.0, "posizione": 1, "pari_merito": True}
+    assert righe["Volpi"]["celle"][str(corsa)] == {"punti": 2.0, "posizione": 3, "pari_merito": False}
+    assert righe["Aquile"]["celle"][str(quiz)] == {"punti": None, "posizione": None, "pari_merito": False}
+    # in classifica generale: Aquile, Lupi e Volpi hanno tutte 5 punti
+    assert {r["posizione"] for r in dati["squadre"]} == {1}
+    assert [r["nome"] for r in dati["squadre"]] == ["Aquile", "Lupi", "Volpi"]
+
+
+def test_tabellone_si_aggiorna_dopo_un_salvataggio(client, contesto, evento):
+    aquile = evento["squadre"][0]
+    corsa = evento["giochi"][1]
+    assert client.get("/tabellone.json").json["squadre"][0]["totale"] == 0
+    client.post(f"/squadre/{aquile}/punteggio/{corsa}", data={"punti": "4"})
+    righe = {r["nome"]: r["totale"] for r in client.get("/tabellone.json").json["squadre"]}
+    assert righe["Aquile"] == 4.0
+
+
+def test_tabellone_con_squadre_senza_giochi(client, contesto):
+    contesto.add_all([main.Squadra(nome=nome, totale=main.TotaleSquadra(totale=0)) for nome in ("Lupi", "Aquile")])
+    contesto.commit()
+    dati = client.get("/tabellone.json").json
+    assert dati["giochi"] == []
+    assert [(r["nome"], r["totale"], r["posizione"], r["celle"]) for r in dati["squadre"]] == [
+        ("Aquile", 0, 1, {}), ("Lupi", 0, 1, {}),
+    ]
+    assert client.get("/tabellone.csv").text.splitlines() == ["posizione,squadra,totale", "1,Aquile,0", "1,Lupi,0"]
+    assert client.get("/tabellone").status_code == 200
+
+
+def test_tabellone_csv_senza_squadre(client, evento):
+    main.Squadra.query.delete()
+    main.db.session.commit()
+    assert client.get("/tabellone.csv").text.splitlines() == ["posizione,squadra,Quiz,Corsa,totale"]